@@ -1,229 +1,340 @@
 import time
-import csv
-import winsound
+import argparse
+import os
+import socket
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
-from bs4 import BeautifulSoup
-from selenium.common.exceptions import TimeoutException
-from selenium.webdriver.chrome.options import Options
+# See helpers.py, extractor.py and fetchers.py for functionality
+from helpers import give_error, fetch_configs_from_file, fetch_urls_from_file, clamp, wait_for_content
+from helpers import get_configs_fingerprint, get_content_hash
+from helpers import AnalysisLog, ConfigRegistry, DriverPool, Failures, ProgressWindow, RetryScheduler, ScraperOutput, WorkItem
+from helpers import SearchConstants as sc
+from extractor import get_parser_backend, search_browser, search_html
+from fetchers import FetchEngine, HostScheduler, HttpFetcher, PageCache
+from store import ResultStore
+from writers import get_output_format, get_output_writer
+from metrics import StageMetrics
+from profiler import SlowPageProfiler
+from coordinator import CoordinatorClient
+from archive import PageArchive
 
-# See helpers.py for functionality
-from helpers import give_error, fetch_configs_from_file, fetch_urls_from_file, get_new_driver, clamp
-from helpers import AnalysisLog, ProgressWindow, SearchConstants as sc
+# winsound is only available on Windows. Elsewhere Gaqipu runs without beeping, and the file can still be imported by the
+# benchmark
+try:
+    import winsound
+except ImportError:
+    winsound = None
 
 
 
-# Basic set up that is required to run the Gaqipu web scraper
-def set_up():
-    global DRIVER
+# Basic set up that is required to run the Gaqipu web scraper. urls is a generator, which reads urls.csv one row at a
+# time as it is used
+def set_up(shard):
+    global DRIVERS
     
     print('\n\n' + (30 * '=') + '\n=           GAQIPU           =\n' + (30 * '=') + '\n\n')
     
     time.sleep(0.5)
         
-    DRIVER = get_new_driver()
+    DRIVERS.start()
     configs, publishers = fetch_configs_from_file()
-    urls = fetch_urls_from_file()
+    urls = fetch_urls_from_file(shard)
     
     return configs, urls, publishers
     
 
 
-def run_scraper(configs, urls):
-    global DRIVER, PROGRESS, LOG, ITERATION
+# Searching a page is split into stages that run at the same time:
+#   1. Fetching    - pages are downloaded by the asyncio fetch engine, or by the fetch workers when it isn't available
+#   2. Rendering   - pages that need JavaScript, or that no configuration matched when downloaded, are rendered by the
+#                    render workers, each borrowing a driver from the pool
+#   3. Extraction  - fetched HTML is put on a bounded queue, and searched by a pool of extraction processes
+# This way the drivers and downloads never sit idle while a page is being parsed, and parsing can use every core.
+# Urls that fail are rendered again by the render workers once the RetryScheduler decides they are due.
+def run_scraper(urls, url_count):
+    global PROGRESS, STORE, WORKER_COUNT, DRIVER_COUNT
     
-    url_index = 0
-    PROGRESS.set_max_value(len(urls))
-    slipped_urls = []
-    last_journal = None
-    journal_configs = []
-    
-    try:
-        
-        # If the first iteration, we overwrite the contents of the file, otherwise we append it
-        if ITERATION == 0:
-            open_style = 'w'
-        else:
-            open_style = 'a'
-            
-        output_file = open('output.csv', open_style, newline='', encoding='utf-8')
-        writer = csv.writer(output_file)
-        
-        if open_style == 'w':
-            # Write column headers to output.csv file
-            writer.writerow(['JOURNAL','ARTICLE','AUTHOR(S)','LINK','DATA AVAILABILITY STATEMENT','NOTES'])
+    PROGRESS.set_max_value(url_count)
+    # The queues of pages waiting to be downloaded and searched are bounded so that they can't pile up in memory.
+    # The render queue is not, so that a page can always be sent back to be rendered without waiting
+    url_queue = queue.Queue(maxsize=WORKER_COUNT * 4)
+    render_queue = queue.Queue()
+    page_queue = queue.Queue(maxsize=EXTRACTION_QUEUE_SIZE)
         
-        for url in urls:
-            
-            start_time = time.perf_counter()
-            
-            # If the journal for this url is the same as the journal of the previous url, then we already have the configurations
-            if url.journal != last_journal:
-                
-                if ITERATION == 0:
-                    LOG.start_new_report(url.journal)
-                else:
-                    LOG.find_report(url.journal)
-                
-                # We close the current file to commit any changes, then re-open it for each new journal.
-                # This helps prevent data loss, as well as stopping the writer from unexpectedly halting the program
-                output_file.close()
-                output_file = open('output.csv', 'a', newline='', encoding='utf-8')
-                writer = csv.writer(output_file)
-                    
-                print('\n' + (30 * '-') + '\nJOURNAL:', url.journal)
-                
-                journal_configs = find_configs(url.journal)
-                print('>>  found', len(journal_configs), 'configuration(s)\n')
-                LOG.add_configs_to_report(len(journal_configs))
-                
-                last_journal = url.journal
-            
-            # Search the page for the data availability statement
-            data, write_to_file, retry_url = search_page(url, journal_configs)
-            
-            if write_to_file:
-                writer.writerow(data)
-            if retry_url:
-                slipped_urls.append(url)
-                
-            execution_time = time.perf_counter() - start_time
-            PROGRESS.update_all(execution_time)
-            url_index += 1
-                
-    except TimeoutException as t:
-        print(str(t))
-        print('A Timeout error occured!')
-        return url_index, slipped_urls
-                    
-    except Exception as e:
-        print(str(e))
-        print('An unexpected error occured!')
-        return -1, slipped_urls
+    retries = RetryScheduler(render_queue, MAX_ATTEMPTS, RETRY_FAILURES)
+    retries.start()
+    output = ScraperOutput(STORE, retries)
+    
+    workers = []
+    for i in range(DRIVER_COUNT):
+        workers.append(threading.Thread(target=render_worker, args=(render_queue, page_queue, output), daemon=True))
+    for i in range(WORKER_COUNT):
+        workers.append(threading.Thread(target=fetch_worker, args=(url_queue, render_queue, page_queue), daemon=True))
+    workers.append(threading.Thread(target=extraction_dispatcher, args=(page_queue, render_queue, output), daemon=True))
+    for worker in workers:
+        worker.start()
         
+    # urls are read one at a time as the workers are ready for them, so the whole list is never held in memory.
+    # When the asyncio engine is available, every page that has to be downloaded is downloaded by it, with many requests
+    # in flight at once. Otherwise the fetch workers download each page themselves. Either way, pages are only
+    # downloaded as fast as the scheduler lets them be
+    download_items = dispatch_items(urls, output, render_queue, page_queue)
+    if ASYNC_FETCH and FetchEngine.is_available():
+        FetchEngine(PER_HOST_LIMIT, TOTAL_FETCH_LIMIT, scheduler=SCHEDULER).fetch_all(download_items, lambda item: queue_downloaded_page(page_queue, render_queue, item))
     else:
-        return url_index, slipped_urls
-
+        if SCHEDULER != None:
+            download_items = SCHEDULER.iter_ready(download_items)
+        for item in download_items:
+            url_queue.put(item)
         
+    # Wait until every url has been searched or has run out of attempts, then stop the workers
+    output.wait_for_all()
+    retries.stop()
+    for i in range(WORKER_COUNT):
+        url_queue.put(None)
+    for i in range(DRIVER_COUNT):
+        render_queue.put(None)
+    page_queue.put(None)
+    for worker in workers:
+        worker.join()
         
-        
-def find_configs(journal):
-    global configs
-    global publishers
-    journal_configs = []
-    
-    for c in configs:
-        if c.journal == journal:
-            # In journals with many links but few data availability statements, the $publisher-standard functionality
-            # was implemented. In these cases, the program finds all configurations under the journal's publisher, and
-            # searches through all of them. Examples of this can be seen in the config.csv file provided.
-            if c.identifier == '$publisher-standard':
-                publisher = find_publisher(c.publisher)
-                journal_configs.extend(publisher.get_publisher_standard())
+    # Every result is written to the store, and the output file is brought up to date
+    STORE.export(get_output_writer(OUTPUT_FORMAT, OUTPUT_PATH, ResultStore.COLUMNS))
+
+
+
+# Turns each url into a WorkItem with its journal's configurations, and sends it on to the right stage. Pages that need
+# rendering go straight to the render workers, and pages that are already in the cache go straight to extraction.
+# Every other item is yielded, to be downloaded - if it was downloaded in an earlier run, only if it has changed
+def dispatch_items(urls, output, render_queue, page_queue):
+    global LOG
+
+    for url in urls:
+
+        # The configuration lookup doesn't depend on the previous url, so urls from different journals can arrive in any order
+        start = time.perf_counter()
+        journal_configs = find_configs(url)
+        lookup_time = time.perf_counter() - start
+
+        # The first time a journal is seen, its report is started
+        if LOG.find_report(url.journal):
+            print('\n' + (30 * '-') + '\nJOURNAL:', url.journal)
+            print('>>  found', len(journal_configs), 'configuration(s)\n')
+            LOG.add_configs_to_report(url.journal, len(journal_configs))
+
+        item = WorkItem(url, journal_configs)
+        item.add_timing('lookup', lookup_time)
+        output.expect()
+
+        if item.requires_js():
+            render_queue.put(item)
+        else:
+            item.previous = find_previous_page(item)
+            html = get_cached_page(item.url)
+            if html != None:
+                item.set_html(html)
+                page_queue.put(item)
             else:
-                journal_configs.append(c)
-            
-    return journal_configs
+                yield item
+
+    output.stop_expecting()
+
 
 
+# Stores a page downloaded by the asyncio fetch engine in the cache, then hands it over to be searched. A page that
+# hasn't changed since the earlier run is handed over too, so that the earlier result is recorded. If it couldn't be
+# downloaded, it is rendered by a driver instead
+def queue_downloaded_page(page_queue, render_queue, item):
+    if item.html != None:
+        store_cached_page(item.url, item.html)
+        page_queue.put(item)
+    elif item.not_modified:
+        page_queue.put(item)
+    else:
+        render_queue.put(item)
+
 
 
-def find_publisher(publisher):
-    global publishers
+# Each fetch worker downloads pages from the url queue with a plain HTTP request until it is told to stop. Pages that
+# can't be downloaded are handed to the render workers
+def fetch_worker(url_queue, render_queue, page_queue):
+    global HTTP
     
-    for p in publishers:
-        if p.has_name(publisher):
-            return p
-        
-    return None
+    while True:
+        item = url_queue.get()
+        if item == None:
+            return
         
+        start = time.perf_counter()
+        HTTP.fetch_item(item)
+        item.add_timing('fetch', time.perf_counter() - start)
+        queue_downloaded_page(page_queue, render_queue, item)
 
 
 
-def search_page(url, configs):
-    global DRIVER
-    global ITERATION
-    
-    exception = ' '
-    statement = ' '
-    
-    # Get page's HTML
-    DRIVER.get(url.link)
-    html = DRIVER.page_source
-    soup = BeautifulSoup(html, 'html.parser')
-                
-    # Search for Data Availability Statement
-    das_found = sc.NOT_FOUND
-    for c in configs:
+# Each render worker renders pages from the render queue until it is told to stop, borrowing a driver from the pool for
+# each one. With BROWSER_EXTRACTION, the page is searched in the driver and the result recorded straight away, otherwise
+# its HTML is handed over to be searched. A url that crashes a driver or times out is handed to the RetryScheduler
+def render_worker(render_queue, page_queue, output):
+    global PROGRESS
+
+    while True:
+        item = render_queue.get()
+        if item == None:
+            return
+
+        url = item.url
+        
         try:
-            if c.tag == None:
-                header = soup.find_all(string=c.identifier)
-            else:
-                header = soup.find_all(c.tag, string=c.identifier)
-            
-            if len(header) == 1:
-                das_found = sc.FOUND
-                address_parent = header[0].parent
-                
-                try:
-                    # METHOD 1 : Search by sibling
-                    statement = address_parent.find_next_sibling(c.search_tag).get_text()
-                except:
-                    try:
-                        # METHOD 2 : Search by tag
-                        statement = address_parent.find(c.search_tag).get_text()
-                    except:
-                        # METHOD 3 : find ultimate parent
-                        while address_parent.get_text() == header[0]:
-                            address_parent = address_parent.parent
-                        statement = address_parent.get_text()
+            html = get_cached_page(url, rendered=True)
+            if html == None and BROWSER_EXTRACTION:
+                item.rendered = True
+                record_result(item, search_with_driver(item), output)
+                continue
+            if html == None:
+                html = fetch_with_driver(item)
+                store_cached_page(url, html, rendered=True)
+            item.set_html(html, rendered=True)
+            page_queue.put(item)
                 
-            elif len(header) > 1:
-                das_found = sc.AMBIGUOUS
-                exception += 'Ambiguity with group ' + str(header) + '. '
-            
         except Exception as e:
-            das_found = sc.ERROR
+            # selenium is only imported once a driver has been used (see helpers.py)
+            from selenium.common.exceptions import TimeoutException
             print(str(e))
-            exception += 'Could not retrieve data availability statement. '
-        
-        if das_found == True:
-            break
-              
-    # Author Finding
-    author_found = sc.NOT_FOUND
-    for c in configs:
-        try:
-            author_set = set()
-            author_string = ''
-            
-            if c.author_secondary_class == None:
-                class_ = soup.find_all(class_=c.author_class)
-                for author in class_:
-                    if c.get_author_by_child:
-                        name = author.findChildren('a', recursive=False)[0].get_text()
-                    else:
-                        name = author.get_text()
-                    if name not in author_set:
-                        author_set.add(name)
-                        author_string += name + ', '
+            if isinstance(e, TimeoutException):
+                print('A Timeout error occured!')
             else:
-                first_names = soup.find_all(class_=c.author_class)
-                surnames = soup.find_all(class_=c.author_secondary_class)
-                for i in range(len(first_names)):
-                    name = first_names[i].get_text() + ' ' + surnames[i].get_text()
-                    if name not in author_set:
-                        author_set.add(name)
-                        author_string += name + ', '
-                        
-            if author_string != '':
-                    author_found = sc.FOUND
-            
-        except Exception as e:
-            author_found = sc.ERROR
-            exception += 'Could not retrieve author data.'
-            
-        if author_found == sc.FOUND:
-            break
+                print('An unexpected error occured!')
+            print('\nProcess halted unexpectedly on ' + url.link + '. Rebooting driver...\n')
+            update_progress(item, output.slip(item), output)
+        
+
+
+# The extraction dispatcher hands each fetched page to the pool of extraction processes. No more than
+# EXTRACTION_QUEUE_SIZE pages are being searched at once, so that the page queue stays bounded. Every page is kept in
+# the archive first, if there is one. A downloaded page that is the same as the one searched in an earlier run isn't
+# searched again - the earlier result is recorded instead
+def extraction_dispatcher(page_queue, render_queue, output):
+    global EXTRACTION_POOL, ARCHIVE
+
+    in_flight = threading.BoundedSemaphore(EXTRACTION_QUEUE_SIZE)
+
+    while True:
+        item = page_queue.get()
+        if item == None:
+            return
+
+        if item.html != None and ARCHIVE != None:
+            ARCHIVE.add(item.url, item.html, item.rendered)
+        if item.html != None and not item.rendered:
+            item.content_hash = get_content_hash(item.html)
+        if item.is_unchanged():
+            item.clear_html()
+            record_result(item, item.previous.result, output)
+            continue
+
+        in_flight.acquire()
+        future = EXTRACTION_POOL.submit(search_html, item.html, item.configs, PARSER_BACKEND)
+        future.add_done_callback(lambda f, item=item: finish_extraction(f, item, render_queue, output, in_flight))
+
+
+
+# Called once a page has been searched. A downloaded page that none of the configurations matched is sent back to be
+# rendered by a driver, otherwise the result is recorded
+def finish_extraction(future, item, render_queue, output, in_flight):
+    global PROGRESS
+
+    in_flight.release()
+
+    # Once a page has been searched its HTML is no longer needed, so it isn't kept in memory. It is only kept until the
+    # url is finished if the profiler might need it
+    html = item.html if PROFILER != None else None
+    item.clear_html()
+
+    try:
+        result = future.result()
+    except Exception as e:
+        print(str(e))
+        print('An unexpected error occured while searching ' + item.url.link + '!')
+        update_progress(item, output.slip(item), output)
+        return
+
+    for stage, seconds in result.timings.items():
+        item.add_timing(stage, seconds)
+
+    if result.no_config_matched() and not item.rendered:
+        render_queue.put(item)
+        return
+
+    record_result(item, result, output, html)
+
+
+
+# Records a searched page's result, unless it failed in a way that is to be retried. html is the page the result was
+# found in, if it is to be saved should the page turn out to be unusually slow
+def record_result(item, result, output, html=None):
+    global LOG, REGISTRY, PROFILER
+
+    data, write_to_file = search_page(item, result)
+    failure = Failures.classify(result.das_found, result.author_found)
+    start = time.perf_counter()
+    execution_time = output.record(item, data, write_to_file, result.das_found, result.author_found, failure)
+    item.add_timing('write', time.perf_counter() - start)
+
+    # The url is only added to the log once it is finished, rather than every time it is searched. A configuration's hit
+    # is only counted when it found the statement in this run, not when the result of an unchanged page is used again.
+    # What was found on a downloaded page is kept with the page's validators and hash, for the next run
+    if execution_time != None:
+        LOG.add_url_to_report(item.url.journal, das=clamp(result.das_found,0,2), author=clamp(result.author_found,0,1))
+        if result.das_config != None and not item.is_unchanged():
+            REGISTRY.add_hit(item.url.journal, result.das_config)
+        if item.content_hash != None:
+            STORE.record_page(item.url.link, item.etag, item.last_modified, item.content_hash, get_configs_fingerprint(item.configs), result)
+        if PROFILER != None:
+            PROFILER.check(item, html)
+        update_progress(item, execution_time, output)
+
+
+
+# Moves the progress bar on and records the url's stage timings when it is finished, then marks the url as finished.
+# This must come after everything else about the url has been recorded, as run_scraper() returns once every url is
+# finished. execution_time is None when the url is to be retried
+def update_progress(item, execution_time, output):
+    global PROGRESS, METRICS
+    if execution_time != None:
+        item.add_timing('total', item.get_elapsed_time())
+        METRICS.observe_item(item)
+        PROGRESS.update_all(execution_time)
+        output.finish()
+
+
+
+# Returns the configurations for a url's journal. If the journal has none, the configurations of the publisher that
+# hosts the url are used instead (see ConfigRegistry in helpers.py). The configurations that have found the most
+# statements for the journal are tried first
+def find_configs(url):
+    global REGISTRY
+    
+    journal_configs = REGISTRY.get_journal_configs(url.journal)
+    if len(journal_configs) == 0:
+        journal_configs = REGISTRY.get_host_configs(url.link)
+    else:
+        REGISTRY.learn_host(url.link, journal_configs)
+        
+    return REGISTRY.sort_configs(url.journal, journal_configs)
+
+
+
+
+# Records what search_html() found on a url's page, printing it to the console and adding it to the log
+def search_page(item, result):
+    
+    url = item.url
+    das_found = result.das_found
+    author_found = result.author_found
         
     # Output the print code to the console
     print_code = '[' + sc.PRINT_CODES[das_found + 1] + '][' + sc.PRINT_CODES[author_found + 1] + ']'
@@ -232,26 +343,185 @@ def search_page(url, configs):
         extension += '(AMBIGUOUS IDENTIFIER(S) FOUND [SEE OUTPUT FILE])  '
     if '!' in print_code:
         extension += '(ERROR RETRIEVING DATA) '
+    if item.is_unchanged():
+        extension += '(UNCHANGED SINCE LAST RUN) '
     print(print_code, url.link, extension)
     
-    title = soup.find(class_=c.title_class)
-    if title != None:
-        title_text = title.get_text()
-    else:
-        title_text = ""
-        extension += '(ARTICLE TITLE NOT FOUND. CHECK CONFIGURATIONS)'
-    
-    retry_url = LOG.add_url_to_report(das=clamp(das_found,0,2), author=clamp(author_found,0,1), iteration=ITERATION)
-        
     # Returns the data in format [Journal, Title, Author(s), Link, Data Availability Statement, Notes]
     return [
         url.journal,
-        title,
-        author_string,
+        result.title,
+        result.authors,
         url.link,
-        statement,
-        exception
-    ], clamp(das_found,0,1), retry_url
+        result.statement,
+        result.exception
+    ], clamp(das_found,0,1)
+
+
+
+# Returns what was found on a url's page in an earlier run, so that it can be used again if the page hasn't changed.
+# Results found with different configurations (i.e. before config.csv was changed) aren't used again
+def find_previous_page(item):
+    global STORE
+    if not SKIP_UNCHANGED:
+        return None
+    page = STORE.get_page(item.url.link)
+    if page == None or page.configs != get_configs_fingerprint(item.configs):
+        return None
+    return page
+
+
+
+# Renders the page in a driver borrowed from the pool, returning its HTML as soon as the parts of the page that the
+# configurations search for are there
+def fetch_with_driver(item):
+    return use_driver(item, lambda driver: driver.page_source)
+
+
+
+# Renders the page in a driver borrowed from the pool, and searches it without leaving the browser. Returns a PageResult
+def search_with_driver(item):
+    return use_driver(item, lambda driver: search_browser(driver, item.configs))
+
+
+
+# Loads the item's page in a driver borrowed from the pool, and returns read_page(driver) once the page is ready. If the
+# driver crashes, it is replaced before the error is passed on. Each step is timed, so that the SlowPageProfiler can
+# show which of them made a page slow. With POLITE_FETCH, the page isn't loaded until the HostScheduler allows a request
+# to its host, and how the host answered is reported back to it, as for downloaded pages
+def use_driver(item, read_page):
+    global DRIVERS, SCHEDULER
+    
+    driver = DRIVERS.acquire()
+    if SCHEDULER != None:
+        start = time.perf_counter()
+        SCHEDULER.acquire(item)
+        item.add_step('render: wait for host', start)
+    start = time.perf_counter()
+    try:
+        try:
+            driver.get(item.url.link)
+        except:
+            # The host didn't answer in time, or the driver crashed loading the page
+            report_to_scheduler(item, None, time.perf_counter() - start)
+            raise
+        step_start = item.add_step('render: load page', start)
+        # The browser doesn't give the status the page was sent with, so a page that loads counts as a normal answer
+        report_to_scheduler(item, 200, step_start - start)
+        wait_for_content(driver, item.configs)
+        step_start = item.add_step('render: wait for content', step_start)
+        page = read_page(driver)
+        item.add_step('render: read page', step_start)
+    except:
+        item.add_timing('render', time.perf_counter() - start)
+        DRIVERS.replace(driver)
+        raise
+    
+    item.add_timing('render', time.perf_counter() - start)
+    DRIVERS.release(driver)
+    return page
+
+
+
+# Reads Gaqipu's command line arguments. The shard to search is returned as (index, count), with index counting from 0,
+# or None if every url is to be searched
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Gaqipu web scraper')
+    parser.add_argument('--shard', help='search only shard i of N of urls.csv, given as i/N (e.g. 2/4)')
+    parser.add_argument('--coordinator', help='search urls leased from a coordinator (see coordinator.py) at this address')
+    parser.add_argument('--worker', default=socket.gethostname(), help='the name this worker gives the coordinator')
+    arguments = parser.parse_args()
+
+    if arguments.shard == None:
+        return arguments
+    try:
+        index, count = arguments.shard.split('/')
+        index, count = int(index), int(count)
+    except ValueError:
+        give_error('--shard must be given as i/N, e.g. 2/4')
+    if count < 1 or index < 1 or index > count:
+        give_error('--shard must be given as i/N, with i between 1 and N')
+    arguments.shard = (index - 1, count)
+    return arguments
+
+
+
+# Searches batches of urls leased from a coordinator (see coordinator.py) until there are none left. Each batch is
+# searched by run_scraper() as usual, with the store holding only that batch, and its results are then sent back.
+# The leases are renewed in the background while a batch is being searched
+def run_worker(client):
+    global STORE
+
+    renewer = threading.Thread(target=client.keep_leases, daemon=True)
+    renewer.start()
+
+    while True:
+        state, urls = client.lease()
+        if state == 'done':
+            break
+        if state == 'wait':
+            time.sleep(client.wait_seconds)
+            continue
+
+        STORE.clear()
+        STORE.add_urls(urls)
+        run_scraper(STORE.iter_unfinished_urls(), len(urls))
+        client.complete(STORE.get_results())
+
+    client.stop()
+
+
+
+# Adds the results of urls finished in earlier runs to the log, so that log.txt covers the whole of urls.csv
+def resume_log():
+    global LOG, STORE, REGISTRY
+    
+    for journal, das_found, author_found in STORE.get_finished_results():
+        if LOG.find_report(journal):
+            LOG.add_configs_to_report(journal, len(REGISTRY.get_journal_configs(journal)))
+        LOG.add_url_to_report(journal, das=clamp(das_found,0,2), author=clamp(author_found,0,1))
+
+
+
+# Starts the pool of extraction processes. Each process is replaced once it has searched tasks_per_child pages, so that
+# memory left behind by searching pages can't build up over a long run. This needs Python 3.11 or newer - on older
+# versions the processes are kept for the whole run
+def start_extraction_pool(processes, tasks_per_child):
+    try:
+        return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'), max_tasks_per_child=tasks_per_child)
+    except TypeError:
+        return ProcessPoolExecutor(max_workers=processes)
+
+
+
+# The page cache sits in front of every download. These return None and do nothing respectively when it is turned off
+def get_cached_page(url, rendered=False):
+    global CACHE
+    if CACHE == None:
+        return None
+    return CACHE.get(url.link, rendered)
+
+
+
+def store_cached_page(url, html, rendered=False):
+    global CACHE
+    if CACHE != None:
+        CACHE.put(url.link, html, rendered)
+
+
+
+# Tells the HostScheduler how the host answered a page loaded by a driver. Does nothing without POLITE_FETCH
+def report_to_scheduler(item, status, seconds):
+    global SCHEDULER
+    if SCHEDULER != None:
+        SCHEDULER.report(item.url.link, status, seconds)
+
+
+
+# Beeps at the start and end of a run, where winsound is available
+def beep():
+    if winsound != None:
+        winsound.Beep(500, 1000)
 
 
 
@@ -260,50 +530,147 @@ def search_page(url, configs):
 ### PROGRAM START ###
 #####################
 
-winsound.Beep(500, 1000)
+# The extraction processes import this file when they start, so the program itself must only run in the main process
+if __name__ == '__main__':
 
-DRIVER = None
-LOG = AnalysisLog()
-ITERATION = 0
+    beep()
 
-PROGRESS = ProgressWindow()
-PROGRESS.start()
+    # A large urls.csv can be split between several Gaqipu processes with --shard i/N, where i runs from 1 to N. Each
+    # process searches every Nth url, and keeps its progress and results in files of its own.
+    # Alternatively, with --coordinator, urls are leased from a coordinator in batches (see coordinator.py), and the
+    # worker's files are named after it
+    arguments = parse_arguments()
+    SHARD = arguments.shard
+    COORDINATOR = arguments.coordinator
+    if COORDINATOR != None:
+        suffix = '_' + arguments.worker
+    elif SHARD == None:
+        suffix = ''
+    else:
+        suffix = '_' + str(SHARD[0] + 1) + 'of' + str(SHARD[1])
+    STORE_PATH = 'gaqipu' + suffix + '.db'
+    OUTPUT_PATH = 'output' + suffix
+    LOG_PATH = 'log' + suffix + '.txt'
+    METRICS_PATH = 'metrics' + suffix + '.json'
 
-configs, urls, publishers = set_up()
+    # The number of headless Chrome sessions that can render pages at the same time
+    DRIVER_COUNT = 4
+    # Lean drivers don't download images, fonts, video, adverts or analytics, and return pages without waiting for them.
+    # Each driver keeps its disk cache in the DRIVER_PROFILES folder between sessions (set to None to start afresh)
+    LEAN_DRIVERS = True
+    DRIVER_PROFILES = 'driver_profiles'
+    # Each driver is quit and replaced after RECYCLE_DRIVER_PAGES pages, or once its Chrome processes use more than
+    # RECYCLE_DRIVER_MEMORY bytes (requires psutil), so that long runs don't slow down as Chrome's memory grows
+    RECYCLE_DRIVER_PAGES = 500
+    RECYCLE_DRIVER_MEMORY = 1536 * 1024 * 1024
+    # The number of drivers kept started and waiting in the background, so that a driver that crashes or is recycled can
+    # be replaced straight away
+    SPARE_DRIVERS = 1
+    # The number of workers downloading pages with plain HTTP requests when the asyncio fetch engine isn't available
+    WORKER_COUNT = 16
+    # Whether pages are downloaded by the asyncio fetch engine (requires aiohttp), and how many of its requests can be
+    # in flight at once, both to each publisher's host and in total
+    ASYNC_FETCH = True
+    PER_HOST_LIMIT = 8
+    TOTAL_FETCH_LIMIT = 200
+    # Pages are downloaded from each publisher's host no faster than the rate given for the publisher in config.csv,
+    # taking turns between hosts, and slowing down when a host asks (see HostScheduler in fetchers.py). Set POLITE_FETCH
+    # to False to download pages as fast as PER_HOST_LIMIT allows
+    POLITE_FETCH = True
+    # Downloaded pages are kept, compressed, in the page_cache folder for CACHE_TTL seconds, up to CACHE_MAX_SIZE bytes in total.
+    # Set USE_CACHE to False to always download pages again
+    USE_CACHE = True
+    CACHE_TTL = 7 * 24 * 60 * 60
+    CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024
+    # The number of processes searching fetched pages, and how many fetched pages can wait to be searched
+    EXTRACTION_PROCESSES = os.cpu_count() or 1
+    EXTRACTION_QUEUE_SIZE = EXTRACTION_PROCESSES * 2
+    # Each extraction process is replaced after searching EXTRACTION_TASKS_PER_CHILD pages
+    EXTRACTION_TASKS_PER_CHILD = 1000
+    # Whether pages rendered by a driver are searched inside the browser, so that only what is found is sent back from
+    # Chrome. Rendered pages aren't kept in the page cache when this is on
+    BROWSER_EXTRACTION = False
+    # The HTML parser used to search pages: 'html.parser' (BeautifulSoup) or 'lxml' (faster, requires lxml)
+    PARSER_BACKEND = get_parser_backend('lxml')
+    # The format results are exported in: 'csv', 'jsonl' or 'parquet' (requires pyarrow)
+    OUTPUT_FORMAT = get_output_format('csv')
+    # Urls that fail with one of RETRY_FAILURES are retried, after a wait that doubles each time, until they have been tried
+    # MAX_ATTEMPTS times. Add Failures.NOT_FOUND to also retry pages where nothing was found
+    MAX_ATTEMPTS = 5
+    RETRY_FAILURES = [Failures.TIMEOUT]
+    # How long each stage of searching an article takes can be read from http://127.0.0.1:METRICS_PORT/metrics while
+    # Gaqipu runs (set to None to turn this off), and is summarised in metrics.json at the end
+    METRICS_PORT = 9464
+    # Pages that take longer to search than PROFILE_PERCENTILE percent of the others are saved to the slow_pages folder,
+    # with a profile of searching them and the time spent on each stage (see profiler.py)
+    PROFILE_SLOW_PAGES = False
+    PROFILE_PERCENTILE = 99
+    # Progress is saved in gaqipu.db, so that a run that stops part way through carries on from where it stopped.
+    # Set RESUME to False to search every url again
+    RESUME = True
+    # When searching urls again, pages downloaded in an earlier run are only downloaded if the publisher says they have
+    # changed, and pages that are the same as before aren't searched again. Set SKIP_UNCHANGED to False to search them all
+    SKIP_UNCHANGED = True
+    # Every page searched outside of the browser is kept in the archive folder, so that it can be searched again later
+    # with replay.py, without a browser or downloading anything (see archive.py)
+    ARCHIVE_PAGES = True
 
-for ITERATION in range(0, 5):
-    
-    if len(urls) == 0:
-        break
-    elif ITERATION > 0:
-        border = ('\n\n' + (30 * '=') + '\n\n')
-        print('\n\n' + border + 'RETRYING ' + str(len(urls)) + ' FAILED ARTICLES.\nPass ' + str(ITERATION + 1) + ' (max 5)' + border)
-        time.sleep(0.5)
-        
-    url_index = 0
-    while url_index < len(urls):
-        
-        if url_index > 0:
-            print('\n\nProcess halted unexpectedly. Rebooting from item ' + str(url_index) + '...\n')
-            DRIVER.quit()
-            DRIVER = get_new_driver()
-            
-        temp_index, urls = run_scraper(configs, urls[url_index:])
-        
-        if temp_index == -1:
-            break
-        else:
-            url_index += temp_index
+    DRIVERS = DriverPool(DRIVER_COUNT, LEAN_DRIVERS, DRIVER_PROFILES, RECYCLE_DRIVER_PAGES, RECYCLE_DRIVER_MEMORY, spares=SPARE_DRIVERS)
+    SCHEDULER = HostScheduler() if POLITE_FETCH else None
+    HTTP = HttpFetcher(WORKER_COUNT, scheduler=SCHEDULER)
+    CACHE = PageCache('page_cache', CACHE_TTL, CACHE_MAX_SIZE) if USE_CACHE else None
+    STORE = ResultStore(STORE_PATH)
+    ARCHIVE = PageArchive('archive', 'gaqipu' + suffix) if ARCHIVE_PAGES else None
+    EXTRACTION_POOL = start_extraction_pool(EXTRACTION_PROCESSES, EXTRACTION_TASKS_PER_CHILD)
+    PROFILER = SlowPageProfiler('slow_pages', PROFILE_PERCENTILE, EXTRACTION_POOL, PARSER_BACKEND) if PROFILE_SLOW_PAGES else None
+    LOG = AnalysisLog()
+    METRICS = StageMetrics()
+    if METRICS_PORT != None:
+        METRICS.start_server(METRICS_PORT)
+
+    PROGRESS = ProgressWindow()
+    PROGRESS.start()
+
+    configs, urls, publishers = set_up(SHARD)
+    REGISTRY = ConfigRegistry(configs, publishers)
+    REGISTRY.load_hits(STORE.get_config_hits())
     
-# The driver needs to be closed, otherwise it stays open in the background
-DRIVER.quit()
+    if COORDINATOR != None:
+        run_worker(CoordinatorClient(COORDINATOR, arguments.worker))
+        STORE.save_config_hits(REGISTRY.get_hits())
+
+    else:
+        # Urls that were finished in an earlier run are skipped, unless RESUME is False
+        if not RESUME:
+            STORE.clear()
+        STORE.add_urls(urls)
+        resume_log()
+        url_count = STORE.count_unfinished_urls()
+        print('Found', url_count, 'unfinished URL(s) in ' + STORE_PATH + '\n')
+
+        # The unfinished urls are streamed from the store. Urls that fail are retried during the same run
+        if url_count > 0:
+            run_scraper(STORE.iter_unfinished_urls(), url_count)
+            STORE.save_config_hits(REGISTRY.get_hits())
+
+    # The drivers need to be closed, otherwise they stay open in the background
+    DRIVERS.quit_all()
+    STORE.close()
+    HTTP.close()
+    EXTRACTION_POOL.shutdown()
+    if ARCHIVE != None:
+        ARCHIVE.close()
+
+    # It generates a log and saves it to the file. Only the total report is printed to the console
+    with open(LOG_PATH, 'w') as log_file:
+        log_file.write(LOG.generate_log())
+    print(LOG.get_total_report() + 'Full report available in ' + LOG_PATH)
 
-# It generates a log and saves it to the file. Only the total report is printed to the console
-with open('log.txt', 'w') as log_file:
-    log_file.write(LOG.generate_log())
-print(LOG.get_total_report() + 'Full report available in log.txt')
+    # The stage timings are saved next to the log
+    METRICS.write_summary(METRICS_PATH)
+    METRICS.stop_server()
 
-winsound.Beep(500, 1000)
+    beep()
 
-# Closes the ProgressBar window
-PROGRESS.quit()
\ No newline at end of file
+    # Closes the ProgressBar window
+    PROGRESS.quit()
@@ -0,0 +1,186 @@
+import base64
+import gzip
+import hashlib
+import os
+import queue
+import threading
+import time
+import uuid
+import zlib
+
+from extractor import search_html
+
+
+# archive.py contains the PageArchive, which keeps a copy of every page Gaqipu searches in a WARC file (the standard
+# format for web archives, readable by tools such as warcio and pywb), and the functions that read it back. replay.py
+# uses them to search an archive again, without a browser or the network - so that config.csv can be tuned against a
+# frozen snapshot of the articles, rather than by scraping thousands of live pages again.
+#
+# Each run writes an archive of its own into the archive folder, named after the time it started:
+#   <prefix>-<date>-<time>.warc.gz  - the pages, each stored as a 'resource' record, gzipped on its own
+#   <prefix>-<date>-<time>.cdx      - an index of the records, one per line: link, journal, rendered, offset and length
+# Because each record is gzipped on its own, the index lets any page be read straight from its offset.
+
+
+
+
+########################
+##    PAGE ARCHIVE    ##
+########################
+
+# Pages are added by the extraction dispatcher in Gaqipu.py, and written by a thread of the archive's own, so that
+# compressing them never holds up the search. No more than queue_size pages wait to be written at once. Each record and
+# index line is flushed as soon as it is written, so that the archive is usable even if Gaqipu crashes. A page that
+# can't be written (e.g. because the disk is full) is left out of the archive, and the thread carries on with the next,
+# so that the extraction dispatcher is never left waiting on a full queue.
+
+class PageArchive:
+
+    def __init__(self, directory, prefix='gaqipu', queue_size=100):
+        os.makedirs(directory, exist_ok=True)
+        name = prefix + '-' + time.strftime('%Y%m%d-%H%M%S')
+        self.path = os.path.join(directory, name + '.warc.gz')
+        self.index_path = os.path.join(directory, name + '.cdx')
+        self.pages = queue.Queue(maxsize=queue_size)
+        self.archive_file = open(self.path, 'wb')
+        self.index_file = open(self.index_path, 'w', encoding='utf-8')
+        self.write_record(build_record('warcinfo', None, 'application/warc-fields', b'software: Gaqipu\r\nformat: WARC File Format 1.0\r\n'))
+        self.thread = threading.Thread(target=self.write_pages, daemon=True)
+        self.thread.start()
+
+    def add(self, url, html, rendered=False):
+        self.pages.put((url, html, rendered))
+
+    def write_pages(self):
+        while True:
+            page = self.pages.get()
+            if page == None:
+                return
+            url, html, rendered = page
+            try:
+                self.write_page(url, html, rendered)
+            except Exception as e:
+                print('Could not archive ' + url.link + ': ' + str(e) + '\n')
+
+    def write_page(self, url, html, rendered):
+        headers = {'Gaqipu-Journal': url.journal, 'Gaqipu-Rendered': 'yes' if rendered else 'no'}
+        offset, length = self.write_record(build_record('resource', url.link, 'text/html; charset=utf-8', html.encode('utf-8'), headers))
+        self.index_file.write('\t'.join([url.link, url.journal, 'yes' if rendered else 'no', str(offset), str(length)]) + '\n')
+        self.index_file.flush()
+
+    # Writes a record as a gzip member of its own, and returns its offset and length in the file
+    def write_record(self, record):
+        data = gzip.compress(record, compresslevel=6)
+        offset = self.archive_file.tell()
+        self.archive_file.write(data)
+        self.archive_file.flush()
+        return offset, len(data)
+
+    # Waits for every page added to be written, then closes the archive
+    def close(self):
+        self.pages.put(None)
+        self.thread.join()
+        self.archive_file.close()
+        self.index_file.close()
+
+
+
+# Builds a WARC/1.0 record. target is the link the record is for, or None for a warcinfo record
+def build_record(record_type, target, content_type, block, extra_headers=None):
+    headers = [
+        ('WARC-Type', record_type),
+        ('WARC-Record-ID', '<urn:uuid:' + str(uuid.uuid4()) + '>'),
+        ('WARC-Date', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+    ]
+    if target != None:
+        headers.append(('WARC-Target-URI', target))
+    headers.append(('WARC-Block-Digest', 'sha1:' + base64.b32encode(hashlib.sha1(block).digest()).decode('ascii')))
+    headers.append(('Content-Type', content_type))
+    if extra_headers != None:
+        headers.extend(extra_headers.items())
+    headers.append(('Content-Length', str(len(block))))
+
+    head = 'WARC/1.0\r\n' + ''.join([name + ': ' + value + '\r\n' for name, value in headers]) + '\r\n'
+    return head.encode('utf-8') + block + b'\r\n\r\n'
+
+
+
+
+########################
+##   ARCHIVE READER   ##
+########################
+
+# Returns the archives in the directory (or the single archive given), oldest first
+def find_archives(path):
+    if os.path.isfile(path):
+        return [path]
+    archives = []
+    for name in sorted(os.listdir(path)):
+        if name.endswith('.warc.gz'):
+            archives.append(os.path.join(path, name))
+    return archives
+
+
+
+# Yields (link, journal, rendered, offset, length) for every page in an archive. The archive's index is used if it has
+# one, otherwise the archive is read through record by record
+def read_index(archive_path):
+    index_path = archive_path[:-len('.warc.gz')] + '.cdx'
+    if not os.path.exists(index_path):
+        for offset, length, record in scan_archive(archive_path):
+            headers, block = parse_record(record)
+            if headers.get('WARC-Type') == 'resource':
+                yield headers['WARC-Target-URI'], headers.get('Gaqipu-Journal', ''), headers.get('Gaqipu-Rendered') == 'yes', offset, length
+        return
+
+    with open(index_path, encoding='utf-8') as index_file:
+        for line in index_file:
+            fields = line.rstrip('\n').split('\t')
+            # A line cut short by a crash is left out
+            if len(fields) == 5:
+                yield fields[0], fields[1], fields[2] == 'yes', int(fields[3]), int(fields[4])
+
+
+
+# Yields (offset, length, record) for every gzip member in an archive, without reading the whole file at once
+def scan_archive(archive_path, chunk_size=65536):
+    with open(archive_path, 'rb') as archive_file:
+        offset = 0
+        while True:
+            decompressor = zlib.decompressobj(wbits=31)
+            record = []
+            while not decompressor.eof:
+                chunk = archive_file.read(chunk_size)
+                if len(chunk) == 0:
+                    return
+                record.append(decompressor.decompress(chunk))
+            end = archive_file.tell() - len(decompressor.unused_data)
+            yield offset, end - offset, b''.join(record)
+            offset = end
+            archive_file.seek(offset)
+
+
+
+# Returns the page's HTML from the record at the offset
+def read_page(archive_path, offset, length):
+    with open(archive_path, 'rb') as archive_file:
+        archive_file.seek(offset)
+        headers, block = parse_record(gzip.decompress(archive_file.read(length)))
+    return block.decode('utf-8')
+
+
+
+# Splits a record into a dictionary of its headers and its block
+def parse_record(record):
+    head, rest = record.split(b'\r\n\r\n', 1)
+    headers = {}
+    for line in head.decode('utf-8').split('\r\n')[1:]:
+        name, value = line.split(':', 1)
+        headers[name.strip()] = value.strip()
+    return headers, rest[:int(headers['Content-Length'])]
+
+
+
+# Searches the page in the record at the offset. Run in the extraction processes by replay.py
+def replay_page(archive_path, offset, length, configs, backend):
+    return search_html(read_page(archive_path, offset, length), configs, backend)
@@ -0,0 +1,439 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+# NOTE: This file is unimportant in the operation of the Gaqipu scraper itself. It is used to measure how quickly Gaqipu
+# searches articles, so that changes to the code or to config.csv can be checked for slowdowns.
+
+# benchmark.py builds an article page for every configuration in config.csv, serves them from a local HTTP server and
+# measures, without touching the network:
+#   parsing   - pages/sec and p50/p95 time per page through search_html(), for each parser backend
+#   fetching  - pages/sec and p50/p95 time per page, for the asyncio fetch engine and the threaded HttpFetcher
+#   runs      - pages/sec, p50/p95 time per article and peak memory through the whole of run_scraper(), for every
+#               fetch and parser backend, with the p50/p95 of each stage (see metrics.py). Each run is made in a process
+#               of its own, so that their memory is measured separately
+# The pages are generated the same way every time, so the numbers from one version of Gaqipu can be compared with the
+# next. Results are printed and saved to benchmark.json in the Gaqipu folder. Pass --baseline with an earlier
+# benchmark.json to see the change in pages/sec.
+#
+# Run from anywhere with:  python benchmark/benchmark.py
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from helpers import fetch_configs_from_file, AnalysisLog, ConfigRegistry, Url, WorkItem
+from extractor import PARSER_BACKENDS, get_parser_backend, search_html
+from fetchers import FetchEngine, HttpFetcher
+from metrics import STAGES, StageMetrics
+
+# Peak memory is sampled with psutil when it is installed, and read with the resource module otherwise
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+FETCH_BACKENDS = ['async', 'threads']
+
+FILLER = ('<div class="filler"><p>Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor '
+          'incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco '
+          'laboris nisi ut aliquip ex ea commodo consequat.</p><img src="figure.png" alt=""><ul><li><a href="#">Related'
+          '</a></li><li><a href="#">Cited by</a></li></ul></div>\n')
+
+
+
+########################
+##      FIXTURES      ##
+########################
+
+# Returns an article page that the given configuration will match, padded with filler to roughly page_size bytes so
+# that it is about as large as a real publisher's page
+def make_page(config, number, page_size):
+    authors = ''
+    for first_name, surname in [('Ann', 'Smith'), ('Bob', 'Jones'), ('Cat', 'Brown'), ('Dan', 'Green')]:
+        if config.author_secondary_class != None:
+            authors += '<span class="' + config.author_class + '">' + first_name + '</span> '
+            authors += '<span class="' + config.author_secondary_class + '">' + surname + '</span>\n'
+        elif config.get_author_by_child:
+            authors += '<div class="' + config.author_class + '"><a href="#">' + first_name + ' ' + surname + '</a></div>\n'
+        else:
+            authors += '<span class="' + config.author_class + '">' + first_name + ' ' + surname + '</span>\n'
+
+    tag = config.tag or 'span'
+    statement = ('<section><' + tag + '>' + config.identifier + '</' + tag + '>' + '<' + config.search_tag + '>The data '
+                 'that support the findings of this study are available from the corresponding author upon reasonable '
+                 'request.</' + config.search_tag + '></section>\n')
+
+    filler = FILLER * max(1, int(page_size / 2 / len(FILLER)))
+    return ('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>Benchmark article ' + str(number) + '</title>'
+            '<script src="analytics.js"></script></head>\n<body>\n'
+            '<h1 class="' + config.title_class + '">Benchmark article ' + str(number) + '</h1>\n' + authors +
+            filler + statement + filler + '</body></html>\n')
+
+
+
+# Returns a list of (journal, file name, configuration), with a page for every configuration in config.csv. Journals
+# using $publisher-standard get a page matching the last of their publisher's configurations, so that every
+# configuration before it has to be tried first
+def get_fixtures(configs, publishers):
+    fixtures = []
+    for c in configs:
+        config = c
+        if c.identifier == '$publisher-standard':
+            for p in publishers:
+                if p.has_name(c.publisher):
+                    config = p.get_publisher_standard()[-1]
+        fixtures.append((c.journal, str(len(fixtures)) + '.html', config))
+    return fixtures
+
+
+
+def write_fixtures(directory, fixtures, page_size):
+    for number, (journal, name, config) in enumerate(fixtures):
+        with open(os.path.join(directory, name), 'w', encoding='utf-8') as page_file:
+            page_file.write(make_page(config, number, page_size))
+
+
+
+# Serves the directory on a local port from a background thread. Query strings are ignored, so that the same page can
+# be requested under many different links
+def start_server(directory):
+    handler = partial(QuietHandler, directory=directory)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+
+# Returns the links to request, cycling through the fixtures until there are page_count of them
+def get_urls(fixtures, port, page_count):
+    urls = []
+    for i in range(page_count):
+        journal, name, config = fixtures[i % len(fixtures)]
+        urls.append(Url(journal, 'http://127.0.0.1:' + str(port) + '/' + name + '?copy=' + str(i)))
+    return urls
+
+
+
+
+########################
+##     BENCHMARKS     ##
+########################
+
+def benchmark_parsing(directory, fixtures, registry, backend, page_count):
+    pages = []
+    for journal, name, config in fixtures:
+        with open(os.path.join(directory, name), encoding='utf-8') as page_file:
+            pages.append((page_file.read(), registry.get_journal_configs(journal)))
+
+    times = []
+    start = time.perf_counter()
+    for i in range(page_count):
+        html, configs = pages[i % len(pages)]
+        page_start = time.perf_counter()
+        search_html(html, configs, backend)
+        times.append(time.perf_counter() - page_start)
+    return summarise(times, time.perf_counter() - start)
+
+
+
+def benchmark_fetching(urls, backend, worker_count):
+    times = []
+    start = time.perf_counter()
+
+    if backend == 'async':
+        # Each item is made as the engine asks for it, so its timer covers waiting for a free connection as well
+        items = (WorkItem(url, []) for url in urls)
+        FetchEngine(8, 200).fetch_all(items, lambda item: times.append(item.get_elapsed_time()))
+    else:
+        fetcher = HttpFetcher(worker_count)
+        def fetch(url):
+            page_start = time.perf_counter()
+            fetcher.fetch_item(WorkItem(url, []))
+            times.append(time.perf_counter() - page_start)
+        with ThreadPoolExecutor(max_workers=worker_count) as executor:
+            list(executor.map(fetch, urls))
+        fetcher.close()
+
+    return summarise(times, time.perf_counter() - start)
+
+
+
+# Runs the given fetch and parser backends through run_scraper() in a separate process, and returns its results. If the
+# run fails, the process's errors are printed and None is returned
+def benchmark_run(fetch_backend, parser_backend, port, page_count):
+    command = [sys.executable, os.path.abspath(__file__), '--run', fetch_backend, parser_backend, '--port', str(port), '--pages', str(page_count)]
+    process = subprocess.run(command, capture_output=True, text=True)
+    for line in process.stdout.splitlines():
+        if line.startswith('RESULT '):
+            return json.loads(line[len('RESULT '):])
+    print('  The run failed (exit code ' + str(process.returncode) + '):')
+    for line in process.stderr.strip().splitlines():
+        print('    ' + line)
+    return None
+
+
+
+# Called in the process started by benchmark_run(). Gaqipu.py keeps its settings in globals, so they are set here as they
+# would be at the bottom of Gaqipu.py, with no drivers, no page cache, and every file kept in a temporary directory
+def run_in_child(fetch_backend, parser_backend, port, page_count):
+    import Gaqipu
+    from concurrent.futures import ProcessPoolExecutor
+    from helpers import Failures
+    from store import ResultStore
+
+    configs, publishers = fetch_configs_from_file()
+    # The pages are served over plain HTTP, so none of them need rendering
+    for c in configs:
+        c.requires_js = False
+    directory = tempfile.mkdtemp()
+    urls = get_urls(get_fixtures(configs, publishers), port, page_count)
+
+    settings = {
+        'DRIVER_COUNT': 1, 'WORKER_COUNT': 16, 'ASYNC_FETCH': fetch_backend == 'async', 'PER_HOST_LIMIT': 8,
+        'TOTAL_FETCH_LIMIT': 200, 'EXTRACTION_PROCESSES': os.cpu_count() or 1, 'EXTRACTION_QUEUE_SIZE': (os.cpu_count() or 1) * 2,
+        'PARSER_BACKEND': parser_backend, 'BROWSER_EXTRACTION': False, 'MAX_ATTEMPTS': 1, 'RETRY_FAILURES': [Failures.TIMEOUT],
+        'OUTPUT_FORMAT': 'csv', 'OUTPUT_PATH': os.path.join(directory, 'output'), 'CACHE': None,
+        'DRIVERS': NoDrivers(), 'HTTP': HttpFetcher(16), 'STORE': ResultStore(os.path.join(directory, 'benchmark.db')),
+        'LOG': AnalysisLog(), 'REGISTRY': ConfigRegistry(configs, publishers), 'PROGRESS': QuietProgress(),
+        'METRICS': RecordingMetrics(), 'PROFILER': None, 'SKIP_UNCHANGED': False, 'SCHEDULER': None, 'ARCHIVE': None
+    }
+    settings['EXTRACTION_POOL'] = ProcessPoolExecutor(max_workers=settings['EXTRACTION_PROCESSES'])
+    for name, value in settings.items():
+        setattr(Gaqipu, name, value)
+
+    store = settings['STORE']
+    store.add_urls(urls)
+    memory = MemorySampler()
+    memory.start()
+    start = time.perf_counter()
+    Gaqipu.run_scraper(store.iter_unfinished_urls(), page_count)
+    elapsed = time.perf_counter() - start
+    # The extraction processes are shut down before the peak is read, so that their memory is counted without psutil
+    settings['EXTRACTION_POOL'].shutdown()
+
+    times = [row[0] for row in store.connection.execute("SELECT seconds FROM urls WHERE status = 'done'").fetchall()]
+    result = summarise(times, elapsed)
+    result['found'] = store.connection.execute("SELECT COUNT(*) FROM urls WHERE das_found = 1").fetchone()[0]
+    result['peak_rss_mb'] = memory.stop()
+    # The p50 and p95 of each stage, from the time every url spent in it
+    result['stages'] = {}
+    for stage in STAGES:
+        stage_times = sorted(settings['METRICS'].times.get(stage, []))
+        if len(stage_times) > 0:
+            result['stages'][stage] = {'p50_ms': round(get_percentile(stage_times, 50) * 1000, 2), 'p95_ms': round(get_percentile(stage_times, 95) * 1000, 2)}
+
+    settings['HTTP'].close()
+    store.close()
+    print('RESULT ' + json.dumps(result))
+
+
+
+# Stands in for the DriverPool. Every page is served over plain HTTP, so a page that has to be rendered is a failure
+class NoDrivers:
+
+    def acquire(self):
+        raise Exception('The benchmark does not render pages')
+
+    def quit_all(self):
+        pass
+
+
+
+# Gaqipu's stage metrics only keep a histogram of each stage, which can't tell apart times in the same bucket. These keep
+# every time as well, so that the benchmark can give exact percentiles
+class RecordingMetrics(StageMetrics):
+
+    def __init__(self):
+        StageMetrics.__init__(self)
+        self.times = {}
+
+    def observe(self, stage, publisher, journal, seconds):
+        StageMetrics.observe(self, stage, publisher, journal, seconds)
+        with self.lock:
+            self.times.setdefault(stage, []).append(seconds)
+
+
+
+# Stands in for the ProgressWindow, without opening a window
+class QuietProgress:
+
+    def set_max_value(self, max_value):
+        pass
+
+    def update_all(self, execution_time):
+        pass
+
+
+
+
+########################
+##      RESULTS       ##
+########################
+
+# Returns the number of pages, pages/sec and the 50th and 95th percentile times (in milliseconds)
+def summarise(times, elapsed):
+    times = sorted(times)
+    if len(times) == 0:
+        return {'pages': 0, 'pages_per_sec': 0, 'p50_ms': None, 'p95_ms': None}
+    return {
+        'pages': len(times),
+        'pages_per_sec': round(len(times) / elapsed, 1),
+        'p50_ms': round(get_percentile(times, 50) * 1000, 2),
+        'p95_ms': round(get_percentile(times, 95) * 1000, 2)
+    }
+
+
+
+def get_percentile(sorted_times, percentile):
+    index = int(round((percentile / 100) * (len(sorted_times) - 1)))
+    return sorted_times[index]
+
+
+
+# Measures the peak memory used by a run in MB, counting the extraction processes as well as this process. With psutil,
+# the memory of this process and all of its children is added up several times a second, and the highest total kept.
+# Without it, the peak of this process is added to the peak of its largest finished child, which the resource module
+# gives. This undercounts when there are several extraction processes, but still changes with the parser backend
+class MemorySampler:
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if psutil != None:
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+
+    def sample(self):
+        process = psutil.Process()
+        while True:
+            total = 0
+            for p in [process] + process.children(recursive=True):
+                try:
+                    total += p.memory_info().rss
+                except psutil.Error:
+                    pass
+            self.peak = max(self.peak, total)
+            if self.stopped.wait(self.interval):
+                return
+
+    # Returns the peak in MB, or None if it can't be measured
+    def stop(self):
+        if self.thread != None:
+            self.stopped.set()
+            self.thread.join()
+            return round(self.peak / (1024 * 1024), 1)
+        if resource != None:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            # ru_maxrss is in bytes on macOS, and in kilobytes everywhere else
+            if sys.platform == 'darwin':
+                return round(peak / (1024 * 1024), 1)
+            return round(peak / 1024, 1)
+        return None
+
+
+
+def print_results(results, baseline):
+    for section in ['parsing', 'fetching', 'runs']:
+        print('\n' + section.upper())
+        for name, result in results[section].items():
+            if result == None:
+                print('  ' + name.ljust(20) + 'failed')
+                continue
+            line = '  ' + name.ljust(20) + str(result['pages_per_sec']).rjust(9) + ' pages/sec   p50 ' + str(result['p50_ms']).rjust(8) + ' ms   p95 ' + str(result['p95_ms']).rjust(8) + ' ms'
+            if 'peak_rss_mb' in result:
+                line += '   peak ' + str(result['peak_rss_mb']) + ' MB'
+            # The change in pages/sec since the baseline, if it has the same benchmark
+            if baseline != None and baseline.get(section, {}).get(name) != None:
+                before = baseline[section][name]['pages_per_sec']
+                if before > 0:
+                    line += '   (' + '{:+.1f}'.format((result['pages_per_sec'] - before) / before * 100) + '%)'
+            print(line)
+            for stage, timing in result.get('stages', {}).items():
+                print('      ' + stage.ljust(16) + 'p50 ' + str(timing['p50_ms']).rjust(8) + ' ms   p95 ' + str(timing['p95_ms']).rjust(8) + ' ms')
+
+
+
+
+#####################
+### PROGRAM START ###
+#####################
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Offline benchmark for the Gaqipu web scraper')
+    parser.add_argument('--pages', type=int, default=500, help='the number of pages searched by each benchmark')
+    parser.add_argument('--page-size', type=int, default=300000, help='the rough size of each page in bytes')
+    parser.add_argument('--output', default='benchmark.json', help='where to save the results')
+    parser.add_argument('--baseline', help='an earlier benchmark.json to compare the results with')
+    parser.add_argument('--run', nargs=2, metavar=('FETCH', 'PARSER'), help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.run != None:
+        run_in_child(arguments.run[0], arguments.run[1], arguments.port, arguments.pages)
+        sys.exit(0)
+
+    configs, publishers = fetch_configs_from_file()
+    registry = ConfigRegistry(configs, publishers)
+    directory = tempfile.mkdtemp()
+    fixtures = get_fixtures(configs, publishers)
+    write_fixtures(directory, fixtures, arguments.page_size)
+    server = start_server(directory)
+    port = server.server_address[1]
+    urls = get_urls(fixtures, port, arguments.pages)
+
+    parser_backends = []
+    for backend in PARSER_BACKENDS:
+        if get_parser_backend(backend) == backend:
+            parser_backends.append(backend)
+    fetch_backends = []
+    for backend in FETCH_BACKENDS:
+        if backend != 'async' or FetchEngine.is_available():
+            fetch_backends.append(backend)
+
+    results = {'pages': arguments.pages, 'page_size': arguments.page_size, 'parsing': {}, 'fetching': {}, 'runs': {}}
+    for backend in parser_backends:
+        print('Parsing with ' + backend + '...')
+        results['parsing'][backend] = benchmark_parsing(directory, fixtures, registry, backend, arguments.pages)
+    for backend in fetch_backends:
+        print('Fetching with ' + backend + '...')
+        results['fetching'][backend] = benchmark_fetching(urls, backend, 16)
+    for fetch_backend in fetch_backends:
+        for parser_backend in parser_backends:
+            print('Running Gaqipu with ' + fetch_backend + ' + ' + parser_backend + '...')
+            results['runs'][fetch_backend + ' + ' + parser_backend] = benchmark_run(fetch_backend, parser_backend, port, arguments.pages)
+    server.shutdown()
+
+    baseline = None
+    if arguments.baseline != None:
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+
+    with open(arguments.output, 'w') as output_file:
+        json.dump(results, output_file, indent=4)
+    print('\nResults saved to ' + arguments.output)
@@ -0,0 +1,189 @@
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# NOTE: This file is unimportant in the operation of the Gaqipu scraper itself. It is used to check that the fetchers
+# behave as Gaqipu.py expects them to, after changes to fetchers.py.
+
+# check_fetchers.py serves a few pages from a local HTTP server and downloads them with the asyncio FetchEngine (when
+# aiohttp is installed) and the threaded HttpFetcher, checking that:
+#   success   - a page that answers 200 is stored on its WorkItem
+#   404       - a page that answers with an error leaves the item without HTML, so Gaqipu.py sends it to be rendered
+#   timeout   - a page that doesn't answer in time is given up on after the fetcher's timeout, also without HTML
+#   limits    - no more than per_host_limit requests are made to the host at the same time (FetchEngine only)
+#   feeding   - a url generator that is slow to give the next url doesn't hold up the downloads already in flight, with
+#               and without a HostScheduler (FetchEngine only)
+# Every item is handed back exactly once. Each check prints PASS or FAIL, and the script exits with 1 if any failed.
+#
+# Run from anywhere with:  python benchmark/check_fetchers.py
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from helpers import Url, WorkItem
+from fetchers import FetchEngine, HostScheduler, HttpFetcher
+
+PAGE = '<html><body><h1>Check page</h1></body></html>'
+PER_HOST_LIMIT = 2
+TIMEOUT = 1
+
+
+
+########################
+##       SERVER       ##
+########################
+
+# /ok waits a moment before answering, so that requests overlap and the per-host limit can be seen. /slow answers long
+# after the fetchers' timeout, and anything else is a 404. The most requests in progress at once is kept on the server
+class CheckHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.most_active = max(server.most_active, server.active)
+        try:
+            path = self.path.split('?')[0]
+            if path == '/ok':
+                time.sleep(0.2)
+                self.send_page(200, PAGE)
+            elif path == '/slow':
+                time.sleep(TIMEOUT * 3)
+                self.send_page(200, PAGE)
+            else:
+                self.send_page(404, 'Not found')
+        except OSError:
+            # The fetcher gave up on the page and closed the connection
+            pass
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def send_page(self, status, body):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+
+def start_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CheckHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.active = 0
+    server.most_active = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+
+
+########################
+##       CHECKS       ##
+########################
+
+# Returns the items to download, as (expected HTML, item)
+def make_items(port):
+    items = []
+    for i in range(6):
+        items.append((PAGE, WorkItem(Url('check', 'http://127.0.0.1:' + str(port) + '/ok?copy=' + str(i)), [])))
+    items.append((None, WorkItem(Url('check', 'http://127.0.0.1:' + str(port) + '/missing'), [])))
+    items.append((None, WorkItem(Url('check', 'http://127.0.0.1:' + str(port) + '/slow'), [])))
+    return items
+
+
+
+# Returns a list of (check, passed). slow_seconds is the time taken to give up on /slow alone, which must be well under
+# the time the server takes to answer it
+def check_results(items, finished, slow_seconds):
+    checks = []
+    for expected, item in items:
+        path = '/' + item.url.link.split('/', 3)[3]
+        checks.append((path + ' gives ' + ('the page' if expected != None else 'no HTML'), item.html == expected))
+    checks.append(('every item handed back once', sorted([id(item) for item in finished]) == sorted([id(item) for expected, item in items])))
+    checks.append(('timeout gives up within ' + str(TIMEOUT + 1) + 's (took ' + str(round(slow_seconds, 2)) + 's)', slow_seconds < TIMEOUT + 1))
+    return checks
+
+
+
+def check_fetch_engine(server):
+    items = make_items(server.server_address[1])
+    finished = []
+    server.most_active = 0
+    FetchEngine(PER_HOST_LIMIT, 10, timeout=TIMEOUT).fetch_all([item for expected, item in items], finished.append)
+    # The fetch timing only covers the request itself, not waiting for the host's other requests to finish
+    checks = check_results(items, finished, items[-1][1].timings['fetch'])
+    checks.append(('no more than ' + str(PER_HOST_LIMIT) + ' requests to the host at once (saw ' + str(server.most_active) + ')', server.most_active <= PER_HOST_LIMIT))
+
+    for name, scheduler in [('without', None), ('with', HostScheduler(default_rate=100, default_burst=100))]:
+        items = [WorkItem(Url('check', 'http://127.0.0.1:' + str(server.server_address[1]) + '/ok?slow=' + str(i)), []) for i in range(2)]
+        finished = []
+        start = time.perf_counter()
+        FetchEngine(PER_HOST_LIMIT, 10, timeout=TIMEOUT, scheduler=scheduler).fetch_all(read_slowly(items), lambda item: finished.append(time.perf_counter() - start))
+        checks.append(('a slow url generator ' + name + ' a scheduler doesn\'t hold up downloads (first page after ' + str(round(finished[0], 2)) + 's)', finished[0] < 0.6))
+    return checks
+
+
+
+# Yields the items, taking a second to give the last one, as dispatch_items() in Gaqipu.py can when the page queue is full
+def read_slowly(items):
+    for i, item in enumerate(items):
+        if i == len(items) - 1:
+            time.sleep(1)
+        yield item
+
+
+
+def check_http_fetcher(server):
+    items = make_items(server.server_address[1])
+    finished = []
+    fetcher = HttpFetcher(4, timeout=TIMEOUT)
+    for expected, item in items:
+        start = time.perf_counter()
+        fetcher.fetch_item(item)
+        slow_seconds = time.perf_counter() - start
+        finished.append(item)
+    fetcher.close()
+    # /slow is the last item
+    return check_results(items, finished, slow_seconds)
+
+
+
+
+#####################
+### PROGRAM START ###
+#####################
+
+if __name__ == '__main__':
+
+    server = start_server()
+    failed = 0
+
+    fetchers = [('HttpFetcher', check_http_fetcher)]
+    if FetchEngine.is_available():
+        fetchers.insert(0, ('FetchEngine', check_fetch_engine))
+    else:
+        print('aiohttp is not installed. Skipping the FetchEngine\n')
+
+    for name, check in fetchers:
+        print(name)
+        for description, passed in check(server):
+            print('  ' + ('PASS' if passed else 'FAIL') + '  ' + description)
+            if not passed:
+                failed += 1
+        print()
+
+    server.shutdown()
+    if failed > 0:
+        print(str(failed) + ' check(s) failed')
+        sys.exit(1)
+    print('All checks passed')
@@ -0,0 +1,225 @@
+import argparse
+import json
+import threading
+import time
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from helpers import give_error, fetch_configs_from_file, fetch_urls_from_file, clamp
+from helpers import AnalysisLog, ConfigRegistry, Url
+from store import ResultStore
+from writers import get_output_format, get_output_writer
+
+
+# coordinator.py shares the urls in urls.csv out between several Gaqipu workers, on one machine or many, and merges
+# their results into a single output.csv and log.txt.
+#
+# Start the coordinator on one machine, in the Gaqipu folder:
+#     python coordinator.py --port 8650
+# By default the coordinator only listens on 127.0.0.1, so only workers on the same machine can reach it. The API has
+# no authentication, so for workers on other machines it has to be opened up on purpose, on a trusted network only:
+#     python coordinator.py --port 8650 --host 0.0.0.0
+# then start any number of workers, each with its own drivers, pointing at it:
+#     python Gaqipu.py --coordinator http://<coordinator's address>:8650 --worker <a name for this worker>
+#
+# Each worker leases a batch of urls, searches it with run_scraper() as usual, and sends the results back. While it is
+# searching, it renews its leases every so often. If a worker dies, its leases run out and its urls are leased to the
+# next worker that asks for more. The coordinator keeps everything in coordinator.db, so it can be stopped and started
+# again without losing any results.
+
+
+
+
+########################
+##    COORDINATOR     ##
+########################
+
+class Coordinator:
+
+    def __init__(self, store, batch_size, lease_seconds, max_attempts):
+        self.store = store
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # How long a worker waits before asking again, when every url left is leased to someone else
+        self.wait_seconds = 10
+
+    # Returns the worker's next batch. The state tells the worker what to do next:
+    #   'work'  - search the urls given
+    #   'wait'  - every url left is leased to another worker. Ask again later, in case that worker dies
+    #   'done'  - every url has been searched
+    def lease(self, worker):
+        urls = self.store.lease_urls(worker, self.batch_size, self.lease_seconds, self.max_attempts)
+        if len(urls) > 0:
+            state = 'work'
+            print('Leased', len(urls), 'URL(s) to', worker)
+        elif self.store.count_leasable_urls(self.max_attempts) > 0:
+            state = 'wait'
+        else:
+            state = 'done'
+        return {
+            'state': state,
+            'urls': [[url.journal, url.link] for url in urls],
+            'lease_seconds': self.lease_seconds,
+            'wait_seconds': self.wait_seconds
+        }
+
+    def renew(self, worker):
+        self.store.renew_leases(worker, self.lease_seconds)
+        return {}
+
+    def complete(self, worker, results):
+        self.store.merge_results(results)
+        print('Received', len(results), 'result(s) from', worker)
+        return {}
+
+    def is_finished(self):
+        return self.store.count_leasable_urls(self.max_attempts) == 0
+
+
+
+# Answers the workers' requests. Every request is a POST with a JSON body holding the worker's name
+class CoordinatorHandler(BaseHTTPRequestHandler):
+
+    def __init__(self, coordinator, *args, **kwargs):
+        self.coordinator = coordinator
+        BaseHTTPRequestHandler.__init__(self, *args, **kwargs)
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if self.path == '/lease':
+                response = self.coordinator.lease(body['worker'])
+            elif self.path == '/renew':
+                response = self.coordinator.renew(body['worker'])
+            elif self.path == '/complete':
+                response = self.coordinator.complete(body['worker'], body['results'])
+            else:
+                self.send_error(404)
+                return
+        except (ValueError, KeyError) as e:
+            self.send_error(400, str(e))
+            return
+
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+
+# Builds the log from every finished url in the store, whichever worker searched it
+def build_log(store, registry):
+    log = AnalysisLog()
+    for journal, das_found, author_found in store.get_finished_results():
+        if log.find_report(journal):
+            log.add_configs_to_report(journal, len(registry.get_journal_configs(journal)))
+        log.add_url_to_report(journal, das=clamp(das_found,0,2), author=clamp(author_found,0,1))
+    return log
+
+
+
+
+########################
+## COORDINATOR CLIENT ##
+########################
+
+# Used by a Gaqipu worker (see run_worker() in Gaqipu.py) to talk to the coordinator. Requests that fail because the
+# coordinator can't be reached are tried again a few times before giving up
+
+class CoordinatorClient:
+
+    def __init__(self, address, worker, timeout=30, tries=5):
+        self.address = address.rstrip('/')
+        self.worker = worker
+        self.timeout = timeout
+        self.tries = tries
+        self.lease_seconds = 600
+        self.wait_seconds = 10
+        self.stopped = threading.Event()
+
+    def call(self, path, data):
+        data['worker'] = self.worker
+        for attempt in range(self.tries):
+            try:
+                response = requests.post(self.address + path, json=data, timeout=self.timeout)
+                response.raise_for_status()
+                return response.json()
+            except requests.RequestException as e:
+                print('Could not reach the coordinator at ' + self.address + ': ' + str(e))
+                if attempt == self.tries - 1:
+                    raise
+                time.sleep(2 ** attempt)
+
+    # Returns the state of the coordinator ('work', 'wait' or 'done') and a list of the Urls leased
+    def lease(self):
+        response = self.call('/lease', {})
+        self.lease_seconds = response['lease_seconds']
+        self.wait_seconds = response['wait_seconds']
+        return response['state'], [Url(journal, link) for journal, link in response['urls']]
+
+    def complete(self, results):
+        self.call('/complete', {'results': [list(result) for result in results]})
+
+    # Renews this worker's leases until stop() is called. Run on a thread of its own
+    def keep_leases(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            try:
+                self.call('/renew', {})
+            except requests.RequestException:
+                pass
+
+    def stop(self):
+        self.stopped.set()
+
+
+
+
+#####################
+### PROGRAM START ###
+#####################
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Shares the urls in urls.csv out between Gaqipu workers')
+    parser.add_argument('--port', type=int, default=8650, help='the port the workers connect to')
+    parser.add_argument('--host', default='127.0.0.1', help='the address to listen on (0.0.0.0 for every interface)')
+    parser.add_argument('--batch-size', type=int, default=100, help='the number of urls leased to a worker at once')
+    parser.add_argument('--lease', type=int, default=600, help='the seconds a lease lasts without being renewed')
+    parser.add_argument('--max-attempts', type=int, default=3, help='the number of times a url is leased before it is given up on')
+    parser.add_argument('--output-format', default='csv', help="'csv', 'jsonl' or 'parquet'")
+    arguments = parser.parse_args()
+
+    configs, publishers = fetch_configs_from_file()
+    registry = ConfigRegistry(configs, publishers)
+    store = ResultStore('coordinator.db')
+    store.add_urls(fetch_urls_from_file())
+    coordinator = Coordinator(store, arguments.batch_size, arguments.lease, arguments.max_attempts)
+
+    try:
+        server = ThreadingHTTPServer((arguments.host, arguments.port), partial(CoordinatorHandler, coordinator))
+    except OSError as e:
+        give_error('Could not listen on port ' + str(arguments.port) + ': ' + str(e))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('Coordinating', store.count_unfinished_urls(), 'unfinished URL(s) on ' + arguments.host + ':' + str(arguments.port), '\n')
+
+    while not coordinator.is_finished():
+        time.sleep(5)
+    # Workers that were told to wait are given time to ask again, and be told that there is nothing left
+    time.sleep(coordinator.wait_seconds * 2)
+    server.shutdown()
+
+    # The results of every worker are merged in the store, so the output and log cover the whole of urls.csv
+    store.export(get_output_writer(get_output_format(arguments.output_format), 'output', ResultStore.COLUMNS))
+    log = build_log(store, registry)
+    with open('log.txt', 'w') as log_file:
+        log_file.write(log.generate_log())
+    print(log.get_total_report() + 'Full report available in log.txt')
+    store.close()
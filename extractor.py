@@ -0,0 +1,470 @@
+import cProfile
+import marshal
+import time
+
+from helpers import SearchConstants as sc
+
+# lxml is only needed by the 'lxml' parser backend
+try:
+    from lxml import etree
+    import lxml.html
+except ImportError:
+    etree = None
+
+
+# extractor.py contains the page searching logic used by Gaqipu.py. It works on a page's HTML only, so it does not
+# matter whether the page was fetched with a plain HTTP request or rendered by a headless Chrome driver.
+#
+# Two parser backends are available:
+#   'html.parser'  - BeautifulSoup with Python's built in parser. This is the original backend, and the slowest
+#   'lxml'         - lxml's C parser, searched with the XPath selectors built for each Configuration when config.csv
+#                    is read. Much faster on large pages, such as Elsevier's
+#
+# Pages rendered by a driver can also be searched inside the browser itself (see search_browser()), so that only what
+# is found has to be sent back from Chrome, rather than the whole page.
+
+PARSER_BACKENDS = ['html.parser', 'lxml']
+
+# Compiled XPath selectors, shared by every page searched in this process
+compiled_selectors = {}
+
+
+
+# Returns the given backend if it can be used, otherwise the original 'html.parser' backend
+def get_parser_backend(backend):
+    if backend == 'lxml' and etree == None:
+        print('lxml is not installed. Using html.parser instead\n')
+        return 'html.parser'
+    if backend not in PARSER_BACKENDS:
+        print('Unknown parser backend ' + str(backend) + '. Using html.parser instead\n')
+        return 'html.parser'
+    return backend
+
+
+
+# Searches the given HTML for the data availability statement, author names and article title, using the given
+# configurations and parser backend. Returns a PageResult holding everything that was found.
+def search_html(html, configs, backend='html.parser'):
+    if backend == 'lxml':
+        return search_html_lxml(html, configs)
+
+    # BeautifulSoup is only imported by the backend that uses it
+    from bs4 import BeautifulSoup
+
+    result = PageResult()
+    start = time.perf_counter()
+    soup = BeautifulSoup(html, 'html.parser')
+    start = result.add_timing('parse', start)
+
+    # Search for Data Availability Statement
+    for c in configs:
+        try:
+            if c.tag == None:
+                header = soup.find_all(string=c.identifier)
+            else:
+                header = soup.find_all(c.tag, string=c.identifier)
+
+            if len(header) == 1:
+                result.das_found = sc.FOUND
+                result.das_config = c.key
+                address_parent = header[0].parent
+
+                try:
+                    # METHOD 1 : Search by sibling
+                    result.statement = address_parent.find_next_sibling(c.search_tag).get_text()
+                except:
+                    try:
+                        # METHOD 2 : Search by tag
+                        result.statement = address_parent.find(c.search_tag).get_text()
+                    except:
+                        # METHOD 3 : find ultimate parent
+                        while address_parent.get_text() == header[0]:
+                            address_parent = address_parent.parent
+                        result.statement = address_parent.get_text()
+
+            elif len(header) > 1:
+                result.das_found = sc.AMBIGUOUS
+                result.exception += 'Ambiguity with group ' + str(header) + '. '
+
+        except Exception as e:
+            result.das_found = sc.ERROR
+            print(str(e))
+            result.exception += 'Could not retrieve data availability statement. '
+
+        if result.das_found == sc.FOUND:
+            break
+    start = result.add_timing('das', start)
+
+    # Author Finding
+    for c in configs:
+        try:
+            author_set = set()
+            author_string = ''
+
+            if c.author_secondary_class == None:
+                class_ = soup.find_all(class_=c.author_class)
+                for author in class_:
+                    if c.get_author_by_child:
+                        name = author.findChildren('a', recursive=False)[0].get_text()
+                    else:
+                        name = author.get_text()
+                    if name not in author_set:
+                        author_set.add(name)
+                        author_string += name + ', '
+            else:
+                first_names = soup.find_all(class_=c.author_class)
+                surnames = soup.find_all(class_=c.author_secondary_class)
+                for i in range(len(first_names)):
+                    name = first_names[i].get_text() + ' ' + surnames[i].get_text()
+                    if name not in author_set:
+                        author_set.add(name)
+                        author_string += name + ', '
+
+            result.authors = author_string
+            if author_string != '':
+                    result.author_found = sc.FOUND
+
+        except Exception as e:
+            result.author_found = sc.ERROR
+            result.exception += 'Could not retrieve author data.'
+
+        if result.author_found == sc.FOUND:
+            break
+    start = result.add_timing('authors', start)
+
+    # The title is found using the title class of the last configuration that was searched
+    if len(configs) > 0:
+        title = soup.find(class_=c.title_class)
+        if title != None:
+            result.title = str(title)
+    result.add_timing('title', start)
+
+    # Everything found has been copied out of the tree as strings, so the tree is freed now rather than whenever the
+    # garbage collector gets round to its many reference cycles
+    soup.decompose()
+    return result
+
+
+
+
+# Searches the page under cProfile, and returns the profile in the format written by pstats' dump_stats(). Used by the
+# SlowPageProfiler (see profiler.py)
+def profile_search_html(html, configs, backend='html.parser'):
+    profiler = cProfile.Profile()
+    profiler.runcall(search_html, html, configs, backend)
+    profiler.create_stats()
+    return marshal.dumps(profiler.stats)
+
+
+
+
+# The lxml version of search_html(). Each search mirrors the BeautifulSoup search it replaces. lxml can't parse an empty
+# page, so nothing is found on it, as with BeautifulSoup. Scripts and styles are removed before searching, as
+# BeautifulSoup leaves their text out of the text it gives
+def search_html_lxml(html, configs):
+    result = PageResult()
+    start = time.perf_counter()
+    if html == None or html.strip() == '':
+        return result
+    try:
+        try:
+            tree = lxml.html.fromstring(html)
+        except ValueError:
+            # lxml won't parse a str that starts with an XML encoding declaration, but will parse its bytes
+            tree = lxml.html.fromstring(html.encode('utf-8'))
+    except etree.ParserError:
+        return result
+    etree.strip_elements(tree, 'script', 'style', with_tail=False)
+    start = result.add_timing('parse', start)
+
+    # Search for Data Availability Statement
+    for c in configs:
+        try:
+            header = get_selector(c.das_selector)(tree, identifier=c.identifier)
+
+            if len(header) == 1:
+                result.das_found = sc.FOUND
+                result.das_config = c.key
+                # A text match belongs to the element it sits in, unless it is the tail text that follows an element
+                if c.tag == None:
+                    address_parent = header[0].getparent()
+                    if header[0].is_tail:
+                        address_parent = address_parent.getparent()
+                else:
+                    address_parent = header[0].getparent()
+
+                # METHOD 1 : Search by sibling
+                statement = first(address_parent.itersiblings(c.search_tag))
+                if statement == None:
+                    # METHOD 2 : Search by tag
+                    statement = first(address_parent.iterdescendants(c.search_tag))
+                if statement != None:
+                    result.statement = get_text(statement)
+                else:
+                    # METHOD 3 : find ultimate parent
+                    while get_text(address_parent) == header[0] and address_parent.getparent() != None:
+                        address_parent = address_parent.getparent()
+                    result.statement = get_text(address_parent)
+
+            elif len(header) > 1:
+                result.das_found = sc.AMBIGUOUS
+                result.exception += 'Ambiguity with group ' + str([str(h) for h in header]) + '. '
+
+        except Exception as e:
+            result.das_found = sc.ERROR
+            print(str(e))
+            result.exception += 'Could not retrieve data availability statement. '
+
+        if result.das_found == sc.FOUND:
+            break
+    start = result.add_timing('das', start)
+
+    # Author Finding
+    for c in configs:
+        try:
+            author_set = set()
+            author_string = ''
+
+            if c.author_secondary_selector == None:
+                for author in get_selector(c.author_selector)(tree):
+                    if c.get_author_by_child:
+                        name = get_text(author.xpath('./a')[0])
+                    else:
+                        name = get_text(author)
+                    if name not in author_set:
+                        author_set.add(name)
+                        author_string += name + ', '
+            else:
+                first_names = get_selector(c.author_selector)(tree)
+                surnames = get_selector(c.author_secondary_selector)(tree)
+                for i in range(len(first_names)):
+                    name = get_text(first_names[i]) + ' ' + get_text(surnames[i])
+                    if name not in author_set:
+                        author_set.add(name)
+                        author_string += name + ', '
+
+            result.authors = author_string
+            if author_string != '':
+                    result.author_found = sc.FOUND
+
+        except Exception as e:
+            result.author_found = sc.ERROR
+            result.exception += 'Could not retrieve author data.'
+
+        if result.author_found == sc.FOUND:
+            break
+    start = result.add_timing('authors', start)
+
+    # The title is found using the title class of the last configuration that was searched
+    if len(configs) > 0:
+        title = get_selector(c.title_selector)(tree)
+        if len(title) > 0:
+            result.title = lxml.html.tostring(title[0], encoding='unicode', with_tail=False)
+    result.add_timing('title', start)
+
+    # As with BeautifulSoup, the tree is freed as soon as the search is finished
+    tree.clear()
+    return result
+
+
+
+# The in-browser version of search_html(), run by a driver on the page it has rendered, so that only what is found is
+# sent back rather than the whole page. Each search mirrors the lxml search, using the same selectors
+BROWSER_SEARCH_SCRIPT = r'''
+    var configs = arguments[0];
+    var result = {das_found: 0, author_found: 0, das_config: null, statement: ' ', authors: '', title: '', exception: ' '};
+
+    function select(xpath) {
+        var snapshot = document.evaluate(xpath, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+        var nodes = [];
+        for (var i = 0; i < snapshot.snapshotLength; i++) {
+            nodes.push(snapshot.snapshotItem(i));
+        }
+        return nodes;
+    }
+
+    // Search for Data Availability Statement
+    for (var i = 0; i < configs.length; i++) {
+        var c = configs[i];
+        try {
+            var header = select(c.das_selector);
+
+            if (header.length == 1) {
+                result.das_found = 1;
+                result.das_config = c.key;
+                var address_parent = header[0].parentNode;
+
+                // METHOD 1 : Search by sibling
+                var statement = address_parent.nextElementSibling;
+                while (statement != null && statement.tagName.toLowerCase() != c.search_tag) {
+                    statement = statement.nextElementSibling;
+                }
+                if (statement == null) {
+                    // METHOD 2 : Search by tag
+                    statement = address_parent.getElementsByTagName(c.search_tag)[0] || null;
+                }
+                if (statement != null) {
+                    result.statement = statement.textContent;
+                } else {
+                    // METHOD 3 : find ultimate parent
+                    while (header[0].nodeType == Node.TEXT_NODE && address_parent.textContent == header[0].nodeValue && address_parent.parentNode != null && address_parent.parentNode.nodeType == Node.ELEMENT_NODE) {
+                        address_parent = address_parent.parentNode;
+                    }
+                    result.statement = address_parent.textContent;
+                }
+
+            } else if (header.length > 1) {
+                result.das_found = 2;
+                var group = header.map(function (h) { return "'" + (h.outerHTML || h.nodeValue) + "'"; });
+                result.exception += 'Ambiguity with group [' + group.join(', ') + ']. ';
+            }
+
+        } catch (e) {
+            result.das_found = -1;
+            result.exception += 'Could not retrieve data availability statement. ';
+        }
+
+        if (result.das_found == 1) {
+            break;
+        }
+    }
+
+    // Author Finding
+    for (var i = 0; i < configs.length; i++) {
+        var c = configs[i];
+        try {
+            var author_set = {};
+            var author_string = '';
+            var name;
+
+            if (c.author_secondary_selector == null) {
+                var authors = select(c.author_selector);
+                for (var j = 0; j < authors.length; j++) {
+                    if (c.get_author_by_child) {
+                        var children = Array.prototype.filter.call(authors[j].children, function (child) { return child.tagName.toLowerCase() == 'a'; });
+                        name = children[0].textContent;
+                    } else {
+                        name = authors[j].textContent;
+                    }
+                    if (!(name in author_set)) {
+                        author_set[name] = true;
+                        author_string += name + ', ';
+                    }
+                }
+            } else {
+                var first_names = select(c.author_selector);
+                var surnames = select(c.author_secondary_selector);
+                for (var j = 0; j < first_names.length; j++) {
+                    name = first_names[j].textContent + ' ' + surnames[j].textContent;
+                    if (!(name in author_set)) {
+                        author_set[name] = true;
+                        author_string += name + ', ';
+                    }
+                }
+            }
+
+            result.authors = author_string;
+            if (author_string != '') {
+                result.author_found = 1;
+            }
+
+        } catch (e) {
+            result.author_found = -1;
+            result.exception += 'Could not retrieve author data.';
+        }
+
+        if (result.author_found == 1) {
+            break;
+        }
+    }
+
+    // The title is found using the title class of the last configuration that was searched
+    if (configs.length > 0) {
+        var title = select(c.title_selector);
+        if (title.length > 0) {
+            result.title = title[0].outerHTML;
+        }
+    }
+
+    return result;
+'''
+
+
+
+# Searches the page open in a driver with BROWSER_SEARCH_SCRIPT. Returns a PageResult, just like search_html()
+def search_browser(driver, configs):
+    selectors = []
+    for c in configs:
+        selectors.append({
+            'key': c.key,
+            'das_selector': c.das_xpath,
+            'search_tag': c.search_tag,
+            'author_selector': c.author_selector,
+            'author_secondary_selector': c.author_secondary_selector,
+            'get_author_by_child': c.get_author_by_child,
+            'title_selector': c.title_selector
+        })
+    found = driver.execute_script(BROWSER_SEARCH_SCRIPT, selectors)
+
+    result = PageResult()
+    result.das_found = found['das_found']
+    result.author_found = found['author_found']
+    result.das_config = found['das_config']
+    result.statement = found['statement']
+    result.authors = found['authors']
+    result.title = found['title']
+    result.exception = found['exception']
+    return result
+
+
+
+# Returns the compiled version of an XPath selector, compiling it the first time it is used
+def get_selector(selector):
+    if selector not in compiled_selectors:
+        compiled_selectors[selector] = etree.XPath(selector)
+    return compiled_selectors[selector]
+
+
+
+def get_text(element):
+    return ''.join(element.itertext())
+
+
+
+def first(elements):
+    for element in elements:
+        return element
+    return None
+
+
+
+########################
+##    PAGE RESULT     ##
+########################
+
+# Stores everything found on a single page by search_html(). The title is stored as the HTML of the title element,
+# which is how it has always been written to output.csv.
+
+class PageResult:
+
+    def __init__(self):
+        self.das_found = sc.NOT_FOUND
+        self.author_found = sc.NOT_FOUND
+        # The key of the configuration that found the data availability statement
+        self.das_config = None
+        self.statement = ' '
+        self.authors = ''
+        self.title = ''
+        self.exception = ' '
+        # The time spent on each stage of the search, in seconds (see metrics.py)
+        self.timings = {}
+
+    # Records the time since start against the stage, and returns the time now, for the next stage to start from
+    def add_timing(self, stage, start):
+        now = time.perf_counter()
+        self.timings[stage] = now - start
+        return now
+
+    # Returns True if none of the configurations matched a data availability statement header on the page
+    def no_config_matched(self):
+        return self.das_found == sc.NOT_FOUND or self.das_found == sc.ERROR
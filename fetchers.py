@@ -0,0 +1,558 @@
+import asyncio
+import gzip
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# aiohttp is only needed by the FetchEngine. Without it, Gaqipu downloads pages with the HttpFetcher instead. It is slow
+# to import, so it is only imported once the FetchEngine is used (see load_aiohttp)
+aiohttp = None
+
+# The PageCache compresses pages with zstandard when it is installed, and with gzip otherwise
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from helpers import get_user_agent, canonicalise_link
+
+
+# fetchers.py contains the ways that Gaqipu can get hold of an article's HTML without rendering it in a headless
+# Chrome driver. Gaqipu.py tries these first, and only falls back to a driver when they do not give a usable page.
+
+
+
+
+########################
+##    HTTP FETCHER    ##
+########################
+
+# The HttpFetcher downloads article pages with plain HTTP requests. A single requests.Session is shared by all of the
+# scraping workers, and its connection pool is sized to match, so that connections to each publisher are kept alive
+# and reused between articles instead of being opened again for every url.
+
+class HttpFetcher:
+
+    def __init__(self, pool_size, timeout=20, scheduler=None):
+        self.timeout = timeout
+        self.scheduler = scheduler
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'User-Agent': get_user_agent(),
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+            'Accept-Language': 'en-GB,en;q=0.9'
+        })
+
+    # Downloads the item's page and stores it on the item. If the page was searched in an earlier run, the server is
+    # only asked to send it if it has changed (see WorkItem.get_conditional_headers in helpers.py)
+    def fetch_item(self, item):
+        start = time.perf_counter()
+        try:
+            response = self.session.get(item.url.link, headers=item.get_conditional_headers(), timeout=self.timeout)
+        except requests.RequestException:
+            report_response(self.scheduler, item, None, time.perf_counter() - start)
+            item.set_html(None)
+            return
+
+        report_response(self.scheduler, item, response.status_code, time.perf_counter() - start, response.headers.get('Retry-After'))
+
+        if response.status_code == 304 and item.previous != None:
+            item.set_validators(response.headers.get('ETag'), response.headers.get('Last-Modified'))
+            item.set_not_modified()
+        elif response.status_code == 200:
+            item.set_validators(response.headers.get('ETag'), response.headers.get('Last-Modified'))
+            item.set_html(response.text)
+        else:
+            item.set_html(None)
+
+    def close(self):
+        self.session.close()
+
+
+
+
+
+########################
+##    FETCH ENGINE    ##
+########################
+
+# The FetchEngine downloads a whole batch of article pages with asyncio, keeping up to total_limit requests in flight at
+# once. Each publisher host has its own semaphore, so that no more than per_host_limit requests are ever made to one
+# host at the same time. As each page arrives, it is stored on its WorkItem and handed to on_page (in Gaqipu.py, this
+# puts it in the queue for the scraping workers to search). The engine only needs a url on each item, so it can be
+# pointed at any server - including a local http.server serving saved pages. Given a HostScheduler, the engine takes
+# items in the order the scheduler releases them, so that no host is sent more requests than it allows.
+
+class FetchEngine:
+
+    # How often, in seconds, the engine looks again for items to download while it is waiting for them to be read
+    FEED_INTERVAL = 0.05
+
+    def __init__(self, per_host_limit, total_limit, timeout=30, scheduler=None):
+        # aiohttp is only imported once it is needed, which may be here if is_available() hasn't been called
+        if not load_aiohttp():
+            raise ImportError('The FetchEngine needs aiohttp, which is not installed')
+        self.per_host_limit = per_host_limit
+        self.total_limit = total_limit
+        self.timeout = timeout
+        self.scheduler = scheduler
+
+    @staticmethod
+    def is_available():
+        return load_aiohttp()
+
+    # Blocks until every item has been downloaded and handed to on_page
+    def fetch_all(self, items, on_page):
+        asyncio.run(self.run(items, on_page))
+
+    async def run(self, items, on_page):
+        host_semaphores = {}
+        total = asyncio.Semaphore(self.total_limit)
+        tasks = set()
+
+        connector = aiohttp.TCPConnector(limit=self.total_limit)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        headers = {
+            'User-Agent': get_user_agent(),
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+            'Accept-Language': 'en-GB,en;q=0.9'
+        }
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers) as session:
+            async for item in self.schedule(items):
+                # Tasks are only created once there is room for them, so a long list of urls never becomes a long
+                # list of waiting tasks
+                await total.acquire()
+
+                host = urlsplit(item.url.link).hostname
+                if host not in host_semaphores:
+                    host_semaphores[host] = asyncio.Semaphore(self.per_host_limit)
+
+                task = asyncio.create_task(self.fetch_item(session, host_semaphores[host], item, on_page))
+                task.add_done_callback(lambda t: total.release())
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            if len(tasks) > 0:
+                await asyncio.gather(*tasks)
+
+    # Yields the items in the order the scheduler releases them, waiting without blocking the event loop while every
+    # host is out of tokens. Without a scheduler, the items are yielded as they are. Reading the next item can be slow
+    # (in Gaqipu.py, each url is looked up in the store and the page cache, and cached pages are put on the page queue,
+    # which may be full), so items are read on a thread of their own, and the downloads in flight carry on meanwhile.
+    # With a scheduler, items are read into it in the background, and released as soon as their host has a token
+    async def schedule(self, items):
+        loop = asyncio.get_running_loop()
+        items = iter(items)
+        feeder = ThreadPoolExecutor(max_workers=1)
+        feeding = None
+        try:
+            if self.scheduler == None:
+                while True:
+                    item = await loop.run_in_executor(feeder, next, items, None)
+                    if item == None:
+                        return
+                    yield item
+
+            feeding = asyncio.ensure_future(self.feed(items, feeder))
+            while True:
+                # Checked before looking for an item, so that no item added at the last moment is missed
+                finished = feeding.done()
+                item, wait = self.scheduler.pop_ready()
+                if item != None:
+                    yield item
+                elif wait == None and finished:
+                    feeding.result()
+                    return
+                else:
+                    await asyncio.sleep(self.FEED_INTERVAL if wait == None else min(wait, self.FEED_INTERVAL))
+        finally:
+            if feeding != None:
+                feeding.cancel()
+            feeder.shutdown(wait=False)
+
+    # Reads items into the scheduler, one at a time, until lookahead of them are waiting or items runs out
+    async def feed(self, items, feeder):
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.scheduler.count >= self.scheduler.lookahead:
+                await asyncio.sleep(self.FEED_INTERVAL)
+                continue
+            item = await loop.run_in_executor(feeder, next, items, None)
+            if item == None:
+                return
+            self.scheduler.add(item)
+
+    async def fetch_item(self, session, host_semaphore, item, on_page):
+        async with host_semaphore:
+            start = time.perf_counter()
+            await self.fetch_page(session, item)
+            item.add_timing('fetch', time.perf_counter() - start)
+
+        # on_page may block (e.g. on a full queue), so it is run outside of the event loop
+        await asyncio.get_running_loop().run_in_executor(None, on_page, item)
+
+    # Downloads the item's page and stores it on the item, in the same way as HttpFetcher.fetch_item()
+    async def fetch_page(self, session, item):
+        start = time.perf_counter()
+        try:
+            async with session.get(item.url.link, headers=item.get_conditional_headers()) as response:
+                report_response(self.scheduler, item, response.status, time.perf_counter() - start, response.headers.get('Retry-After'))
+                if response.status == 304 and item.previous != None:
+                    item.set_validators(response.headers.get('ETag'), response.headers.get('Last-Modified'))
+                    item.set_not_modified()
+                elif response.status == 200:
+                    item.set_validators(response.headers.get('ETag'), response.headers.get('Last-Modified'))
+                    item.set_html(await response.text())
+                else:
+                    item.set_html(None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeDecodeError):
+            report_response(self.scheduler, item, None, time.perf_counter() - start)
+            item.set_html(None)
+
+
+
+
+
+########################
+##   HOST SCHEDULER   ##
+########################
+
+# The HostScheduler decides when each page may be downloaded, so that Gaqipu never sends a publisher's host more
+# requests than it will put up with. Each host has a TokenBucket, filled at the rate given for its publisher in
+# config.csv (every journal of a publisher has the same rate, see get_publisher_settings in helpers.py). If urls with
+# the configurations of several publishers are downloaded from the same host, the lowest of their rates is used, and a
+# host whose urls have no configurations at all uses the default rate. Urls waiting to be downloaded are held in a
+# queue for each host, up to lookahead urls in total, and are released in turn from every host that has a token to
+# spare - so while one host is being waited on, pages are downloaded from the others rather than nothing happening at
+# all. Pages rendered by a driver take a token from the same bucket with acquire(), which waits until there is one.
+# The rate of a host is halved whenever it answers with 429 (Too Many Requests), 403 (Forbidden) or 503 (Service
+# Unavailable), and lowered when it is slow to answer or doesn't answer at all. It then creeps back up to the rate in
+# config.csv as long as the host keeps answering normally.
+
+class HostScheduler:
+
+    THROTTLED_STATUSES = [429, 403, 503]
+
+    def __init__(self, lookahead=2000, slow_seconds=10, default_rate=2, default_burst=4):
+        self.lookahead = lookahead
+        self.slow_seconds = slow_seconds
+        self.default_rate = default_rate
+        self.default_burst = default_burst
+        self.queues = {}
+        self.buckets = {}
+        # The hosts whose rate has been taken from config.csv, rather than the default
+        self.configured = set()
+        # The hosts with urls waiting, in the order they are to be offered a turn
+        self.hosts = deque()
+        self.count = 0
+        self.lock = threading.Lock()
+
+    # Yields the items in the order they are released, sleeping while every host is out of tokens
+    def iter_ready(self, items):
+        items = iter(items)
+        while True:
+            self.fill(items)
+            item, wait = self.pop_ready()
+            if item != None:
+                yield item
+            elif wait == None:
+                return
+            else:
+                time.sleep(wait)
+
+    # Reads items into the host queues until lookahead of them are waiting, or items runs out
+    def fill(self, items):
+        while self.count < self.lookahead:
+            item = next(items, None)
+            if item == None:
+                return
+            self.add(item)
+
+    def add(self, item):
+        host = get_host(item.url.link)
+        with self.lock:
+            self.get_bucket(host, item.configs)
+            if host not in self.queues:
+                self.queues[host] = deque()
+                self.hosts.append(host)
+            self.queues[host].append(item)
+            self.count += 1
+
+    # Returns the host's bucket, limited to the lowest rate of the configurations given and any given before. Must be
+    # called while holding the lock
+    def get_bucket(self, host, configs):
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.default_rate, self.default_burst)
+        if len(configs) > 0:
+            rate = min([c.request_rate for c in configs])
+            burst = min([c.request_burst for c in configs])
+            if host in self.configured:
+                rate = min(rate, self.buckets[host].max_rate)
+                burst = min(burst, self.buckets[host].burst)
+            self.buckets[host].set_limits(rate, burst)
+            self.configured.add(host)
+        return self.buckets[host]
+
+    # Waits until a request may be made to the item's host, then takes a token for it. Used for pages that aren't
+    # released by iter_ready(), such as those rendered by a driver
+    def acquire(self, item):
+        host = get_host(item.url.link)
+        while True:
+            with self.lock:
+                bucket = self.get_bucket(host, item.configs)
+                wait = bucket.get_wait(time.monotonic())
+                if wait == 0:
+                    bucket.take()
+                    return
+            time.sleep(wait)
+
+    # Returns (item, 0) for the next item that may be downloaded. If none may be yet, returns (None, wait), where wait
+    # is the number of seconds until one may, or (None, None) if there are no items waiting at all
+    def pop_ready(self):
+        now = time.monotonic()
+        with self.lock:
+            shortest_wait = None
+            for i in range(len(self.hosts)):
+                host = self.hosts[i]
+                bucket = self.buckets[host]
+                wait = bucket.get_wait(now)
+                if wait == 0:
+                    bucket.take()
+                    item = self.queues[host].popleft()
+                    self.count -= 1
+                    # The next host in line is offered the next turn, and hosts without urls waiting are dropped
+                    self.hosts.rotate(-(i + 1))
+                    if len(self.queues[host]) == 0:
+                        del self.queues[host]
+                        self.hosts.remove(host)
+                    return item, 0
+                if shortest_wait == None or wait < shortest_wait:
+                    shortest_wait = wait
+            return None, shortest_wait
+
+    # Adapts the host's rate to how it answered a request. status is None if it didn't answer
+    def report(self, link, status, seconds, retry_after=None):
+        host = get_host(link)
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket == None:
+                return
+            if status in self.THROTTLED_STATUSES:
+                bucket.slow_down(0.5, get_retry_after(retry_after))
+                print('>>  ' + host + ' answered ' + str(status) + ', slowing down to ' + str(round(bucket.rate, 2)) + ' request(s) per second\n')
+            elif status == None or seconds > self.slow_seconds:
+                bucket.slow_down(0.75)
+            else:
+                bucket.speed_up()
+
+
+
+# A token bucket holds up to burst tokens, and is refilled with rate tokens each second. A request may only be made to
+# the host when there is a whole token to take
+class TokenBucket:
+
+    def __init__(self, rate, burst, min_rate=0.05):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.min_rate = min_rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    # Returns the number of seconds until a token can be taken
+    def get_wait(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    # Changes the rate the bucket is refilled at and the tokens it can hold. If the host has been slowed down, it stays
+    # slowed down by the same amount
+    def set_limits(self, rate, burst):
+        self.rate = min(rate, self.rate / self.max_rate * rate)
+        self.max_rate = rate
+        self.burst = max(1, burst)
+        self.tokens = min(self.tokens, self.burst)
+
+    # Lowers the rate, and empties the bucket. If pause is given, no requests are made for that many seconds
+    def slow_down(self, factor, pause=None):
+        self.rate = max(self.min_rate, self.rate * factor)
+        self.tokens = 0
+        if pause != None:
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+
+    def speed_up(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+
+
+# Imports aiohttp the first time it is needed. Returns False if it isn't installed
+def load_aiohttp():
+    global aiohttp
+    if aiohttp == None:
+        try:
+            import aiohttp as module
+        except ImportError:
+            return False
+        aiohttp = module
+    return True
+
+
+
+# Tells the scheduler (if there is one) how the host answered a request for the item's page
+def report_response(scheduler, item, status, seconds, retry_after=None):
+    if scheduler != None:
+        scheduler.report(item.url.link, status, seconds, retry_after)
+
+
+
+def get_host(link):
+    return urlsplit(link).hostname or ''
+
+
+
+# Returns the number of seconds in a Retry-After header, or None if it isn't given as a number of seconds
+def get_retry_after(value):
+    try:
+        return max(0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+
+
+
+########################
+##     PAGE CACHE     ##
+########################
+
+# The PageCache keeps a compressed copy of every downloaded page on disk, so that retry passes, restarts after a crash
+# and re-runs after changing config.csv don't have to download the same pages again. Each page is stored in a file
+# named after a hash of its canonical url (see canonicalise_link in helpers.py), with the time it was fetched written
+# on the first line. Pages older than ttl seconds are treated as missing, and once the cache grows past max_size bytes
+# the least recently used pages are deleted. Pages rendered by a headless Chrome driver are stored separately from
+# plainly downloaded ones.
+
+class PageCache:
+
+    def __init__(self, directory, ttl, max_size):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        if zstandard != None:
+            self.extension = '.zst'
+        else:
+            self.extension = '.gz'
+
+        os.makedirs(directory, exist_ok=True)
+        self.size = 0
+        for path in self.get_files():
+            self.size += os.path.getsize(path)
+
+    # Returns the cached HTML for the link, or None if it isn't cached or has expired
+    def get(self, link, rendered=False):
+        path = self.get_path(link, rendered)
+        try:
+            with open(path, 'rb') as cache_file:
+                data = self.decompress(cache_file.read(), path)
+            timestamp, html = data.split(b'\n', 1)
+            timestamp = float(timestamp)
+        except Exception:
+            return None
+
+        if time.time() - timestamp > self.ttl:
+            self.remove(path)
+            return None
+
+        # Touching the file marks it as recently used, so it is evicted last
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return html.decode('utf-8')
+
+    def put(self, link, html, rendered=False):
+        path = self.get_path(link, rendered)
+        data = self.compress(str(time.time()).encode('utf-8') + b'\n' + html.encode('utf-8'))
+
+        with self.lock:
+            if os.path.exists(path):
+                self.size -= os.path.getsize(path)
+            temp_path = path + '.' + str(threading.get_ident()) + '.tmp'
+            with open(temp_path, 'wb') as cache_file:
+                cache_file.write(data)
+            os.replace(temp_path, path)
+            self.size += len(data)
+
+            if self.size > self.max_size:
+                self.evict()
+
+    # Deletes the least recently used pages until the cache is back down to 90% of its maximum size
+    def evict(self):
+        files = []
+        for path in self.get_files():
+            try:
+                files.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except OSError:
+                pass
+        files.sort()
+
+        for mtime, size, path in files:
+            if self.size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+
+    def remove(self, path):
+        with self.lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+
+    def get_files(self):
+        paths = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.zst') or name.endswith('.gz'):
+                paths.append(os.path.join(self.directory, name))
+        return paths
+
+    def get_path(self, link, rendered):
+        key = canonicalise_link(link)
+        if rendered:
+            key = 'rendered ' + key
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + self.extension)
+
+    def compress(self, data):
+        if self.extension == '.zst':
+            return zstandard.ZstdCompressor().compress(data)
+        return gzip.compress(data)
+
+    def decompress(self, data, path):
+        if path.endswith('.zst'):
+            return zstandard.ZstdDecompressor().decompress(data)
+        return gzip.decompress(data)
@@ -1,13 +1,26 @@
 import subprocess
 import sys
+import os
 import csv
-import tkinter as tk
-from tkinter import ttk
 import threading
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from fake_useragent import UserAgent
+import queue
+import time
+import heapq
+import random
+import re
+import hashlib
+from urllib.parse import urlsplit, urlunsplit
+
+# selenium, tkinter and fake_useragent are slow to import, so they are only imported by the functions that use them.
+# This way, processes that never open a driver or a window (such as the extraction processes, coordinator.py and
+# benchmark.py) start quickly
+
+# psutil is only needed to measure how much memory each driver's Chrome processes use. Without it, drivers are only
+# recycled after a number of pages
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 
 # helpers.py contains a range of methods and classes that are used by launcher.py and Gaqipu.py
@@ -23,12 +36,97 @@ def give_error(message, close_program=True):
         
         
 
+# The user agents are read once, from USER_AGENTS_FILE, rather than building a new UserAgent() (which is slow, and may
+# go online) for every driver. If the file doesn't exist yet, it is made from fake_useragent's list, or from
+# FALLBACK_USER_AGENTS if that can't be loaded
+USER_AGENTS_FILE = 'user_agents.txt'
+USER_AGENTS = None
+USER_AGENTS_LOCK = threading.Lock()
+
+FALLBACK_USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36 Edg/124.0.0.0'
+]
+
+
+
+# Returns a random fake user agent
+# This is required as some websites block standard Selenium Chromedriver access, as well as plain HTTP requests
+def get_user_agent():
+    return random.choice(load_user_agents())
+
+
+
+def load_user_agents():
+    global USER_AGENTS
+    with USER_AGENTS_LOCK:
+        if USER_AGENTS != None:
+            return USER_AGENTS
+
+        try:
+            with open(USER_AGENTS_FILE) as agents_file:
+                USER_AGENTS = [line.strip() for line in agents_file if line.strip() != '']
+        except OSError:
+            USER_AGENTS = []
+
+        if len(USER_AGENTS) == 0:
+            USER_AGENTS = get_fake_user_agents()
+            try:
+                with open(USER_AGENTS_FILE, 'w') as agents_file:
+                    agents_file.write('\n'.join(USER_AGENTS) + '\n')
+            except OSError:
+                pass
+        return USER_AGENTS
+
+
+
+# Returns up to count different user agents from fake_useragent
+def get_fake_user_agents(count=50):
+    agents = []
+    try:
+        from fake_useragent import UserAgent
+        ua = UserAgent()
+        for i in range(count * 4):
+            agent = ua.random
+            if agent not in agents:
+                agents.append(agent)
+            if len(agents) >= count:
+                break
+    except:
+        pass
+    if len(agents) == 0:
+        return list(FALLBACK_USER_AGENTS)
+    return agents
+
+
+
+# Requests matching these patterns are blocked in lean drivers. None of them are needed to find an article's data
+# availability statement, authors or title: images, video and audio, web fonts, and adverts and analytics
+BLOCKED_URLS = [
+    '*.png', '*.jpg', '*.jpeg', '*.gif', '*.webp', '*.svg', '*.ico',
+    '*.mp4', '*.webm', '*.mp3', '*.m3u8',
+    '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot',
+    '*google-analytics.com*', '*googletagmanager.com*', '*doubleclick.net*', '*googlesyndication.com*',
+    '*facebook.net*', '*hotjar.com*', '*scorecardresearch.com*', '*adobedtm.com*', '*omtrdc.net*',
+    '*newrelic.com*', '*nr-data.net*', '*chartbeat.com*', '*quantserve.com*', '*crazyegg.com*', '*altmetric.com*'
+]
+
+
+
 # Creates and returns a new webdriver with a fake user agent.
-def get_new_driver():
+# A lean driver doesn't wait for images and stylesheets to finish loading before a page is returned (the 'eager' page
+# load strategy), and doesn't download anything in BLOCKED_URLS at all. If a profile directory is given, the driver
+# keeps its disk cache there, so that the publishers' scripts don't have to be downloaded again by its replacement
+def get_new_driver(lean=False, profile_dir=None):
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.chrome.service import Service
+
     # Establish a fake user agent
-    # This is required as some websites block standard Selenium Chromedriver access
-    ua = UserAgent()
-    user_agent = ua.random
+    user_agent = get_user_agent()
     
     # Create options for ChromeDriver
     # Hides Chrome window GUI and applies the fake user agent
@@ -37,12 +135,77 @@ def get_new_driver():
     options.add_argument('--disable-blink-features=AutomationControlled')    
     options.add_argument('--headless=new')
     options.add_argument('--window-size=1920,1080')
+    if profile_dir != None:
+        options.add_argument('--user-data-dir=' + os.path.abspath(profile_dir))
+    if lean:
+        options.page_load_strategy = 'eager'
+        options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
     print('New Webdriver Session:', user_agent, '\n')
     service = Service(executable_path='./chromedriver.exe')
-    return webdriver.Chrome(options=options, service=service)
+    driver = webdriver.Chrome(options=options, service=service)
+
+    if lean:
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': BLOCKED_URLS})
+    return driver
     
     
 
+# Run in the browser to check whether the data availability header and the authors of any of the given configurations
+# are on the page yet. Each selector is a pair of XPaths, [header, authors]. Returns 'found' if they are, and otherwise
+# the page's readyState ('loading', 'interactive' or 'complete')
+CONTENT_READY_SCRIPT = '''
+    var selectors = arguments[0];
+    for (var i = 0; i < selectors.length; i++) {
+        var found = true;
+        for (var j = 0; j < selectors[i].length; j++) {
+            var count = document.evaluate('count(' + selectors[i][j] + ')', document, null, XPathResult.NUMBER_TYPE, null);
+            if (count.numberValue == 0) {
+                found = false;
+                break;
+            }
+        }
+        if (found) {
+            return 'found';
+        }
+    }
+    return document.readyState;
+'''
+
+
+
+# Waits until the data availability header and authors of one of the configurations are on the page, checking several
+# times a second, then stops the page from loading anything else. Publishers' pages often carry on loading scripts for
+# seconds after the article itself is there. Many pages have no statement at all, or a layout that none of the
+# configurations match, so the wait also ends settle_seconds after the page has finished loading, giving scripts run
+# on load a moment to build the page. The longest of the configurations' render waits is only an upper bound, for pages
+# that never finish loading
+def wait_for_content(driver, configs, settle_seconds=1):
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.common.exceptions import TimeoutException
+
+    selectors = [[c.das_xpath, c.author_selector] for c in configs]
+    timeout = max([c.render_wait for c in configs] + [0])
+    loaded = []
+
+    def is_ready(d):
+        state = d.execute_script(CONTENT_READY_SCRIPT, selectors)
+        if state == 'found':
+            return True
+        if state == 'complete':
+            if len(loaded) == 0:
+                loaded.append(time.monotonic())
+            return time.monotonic() - loaded[0] >= settle_seconds
+        return False
+
+    try:
+        WebDriverWait(driver, timeout, poll_frequency=0.2).until(is_ready)
+    except TimeoutException:
+        pass
+    driver.execute_script('window.stop();')
+
+
+
 # Opens and reads both publishers and configurations from config.csv
 def fetch_configs_from_file():
     configs = []
@@ -50,57 +213,121 @@ def fetch_configs_from_file():
     try:
         with open('config.csv', newline='') as config_file:
             line_reader = csv.reader(config_file, delimiter=',')
-            first = True
-            for row in line_reader:
+            rows = [row for row in line_reader if len(row) > 0][1:]
+            settings = get_publisher_settings(rows)
+            for row in rows:
                 
-                if first == False:
-                    new_config = Configuration(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8])
-                    configs.append( new_config )
+                new_config = Configuration(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8], *settings[row[0].lower()])
+                configs.append( new_config )
                     
-                    found = False
-                    for publisher in publishers:
-                        found = publisher.try_add_config(new_config)
-                        if found:
-                            break
+                found = False
+                for publisher in publishers:
+                    found = publisher.try_add_config(new_config)
+                    if found:
+                        break
                         
-                    if found == False:
-                        new_publisher = Publisher(row[0])
-                        new_publisher.add_config(new_config)
-                        publishers.append(new_publisher)
-                        
-                else:
-                    first = False
+                if found == False:
+                    new_publisher = Publisher(row[0])
+                    new_publisher.add_config(new_config)
+                    publishers.append(new_publisher)
                     
         print('Found', len(configs), 'configuration(s) in configs.csv')
         print('Found', len(publishers), 'publisher(s) in configs.csv\n')
         return configs, publishers
     except:
         give_error('Could not find config.csv, or failed reading it.')
+
+
+
+# The JS rendering, render wait and request rate columns of config.csv describe how a publisher's site behaves, rather
+# than a journal, so every journal of a publisher is given the same values. Rows that leave a column out (as older
+# config files do) take the value of the publisher's other rows, or the default if none of them give it. If the rows
+# of a publisher disagree, a warning is printed and the strictest value is used: rendering if any row asks for it, the
+# longest render wait, and the lowest request rate and burst. Returns the values for each publisher, by name
+PUBLISHER_COLUMNS = [
+    (9, 'REQUIRES JS RENDERING?', 'no', lambda values: 'yes' if 'yes' in values else 'no'),
+    (10, 'RENDER WAIT (SECONDS)', '10', lambda values: max(values, key=float)),
+    (11, 'REQUESTS PER SECOND', '2', lambda values: min(values, key=float)),
+    (12, 'REQUEST BURST', '4', lambda values: min(values, key=float))
+]
+
+def get_publisher_settings(rows):
+    given = {}
+    for row in rows:
+        publisher = row[0].lower()
+        if publisher not in given:
+            given[publisher] = [set() for column in PUBLISHER_COLUMNS]
+        for i, (index, name, default, choose) in enumerate(PUBLISHER_COLUMNS):
+            if len(row) > index and row[index].strip() != '':
+                given[publisher][i].add(row[index].strip().lower())
+
+    settings = {}
+    for publisher, publisher_values in given.items():
+        settings[publisher] = []
+        for (index, name, default, choose), values in zip(PUBLISHER_COLUMNS, publisher_values):
+            if len(values) == 0:
+                settings[publisher].append(default)
+                continue
+            value = choose(values)
+            if len(values) > 1:
+                print('Warning: the ' + publisher + ' rows of config.csv disagree on ' + name + ' (' + ', '.join(sorted(values)) + '). Using ' + value)
+            settings[publisher].append(value)
+    return settings
     
     
 
 # Opens and reads article links from urls.csv
-def fetch_urls_from_file():
-    urls = []
+def fetch_urls_from_file(shard=None):
     try:
         with open('urls.csv', newline='') as config_file:
             journal = ''
+            found = 0
             line_reader = csv.reader(config_file, delimiter=',')
-            for row in line_reader:
+            for index, row in enumerate(line_reader):
+                if len(row) == 0:
+                    continue
+                # A row without a journal belongs to the journal above it, so the journal is carried over from every
+                # row, including rows belonging to other shards
                 if len(row) > 1:
                     journal = row[0]
-                    new_url = Url(journal, row[1])
+                    link = row[1]
                 else:
-                    new_url = Url(journal, row[0])
-                urls.append( new_url )
-        print('Found', len(urls), 'URL(s) in urls.csv\n')
-        return urls
-    except:
+                    link = row[0]
+                if shard == None or index % shard[1] == shard[0]:
+                    found += 1
+                    yield Url(journal, link)
+        print('Found', found, 'URL(s) in urls.csv\n')
+    # Only errors opening or reading the file are caught, as a bare except would also catch the GeneratorExit raised
+    # when the generator is closed before the last url
+    except (OSError, csv.Error, UnicodeDecodeError):
         give_error('Could not find url.csv, or failed reading it.')
         
         
         
     
+# Returns an XPath selector matching elements by class, in the same way as BeautifulSoup's class_ argument: a single
+# class name matches any element with that class, while several class names must match the class attribute exactly
+def get_class_selector(class_name):
+    if ' ' in class_name.strip():
+        return '//*[@class = ' + "'" + class_name + "'" + ']'
+    return '//*[contains(concat(' + "' '" + ', normalize-space(@class), ' + "' '" + '), ' + "' " + class_name.strip() + " '" + ')]'
+
+
+
+# Returns the text as an XPath string, for selectors run where variables can't be passed in (i.e. in the browser)
+def get_xpath_string(text):
+    if "'" not in text:
+        return "'" + text + "'"
+    if '"' not in text:
+        return '"' + text + '"'
+    # Text with both kinds of quote is split at each ', and the pieces joined back together with concat()
+    parts = ["'" + part + "'" for part in text.split("'")]
+    separator = ', "' + "'" + '", '
+    return 'concat(' + separator.join(parts) + ')'
+    
+    
+    
+
 # Clamps a number between two values
 def clamp(num, minnum, maxnum):
     return max(min(maxnum, num), minnum)
@@ -121,8 +348,12 @@ class ProgressWindow(threading.Thread):
 
     def __init__(self):
         threading.Thread.__init__(self)
+        self.lock = threading.Lock()
         
     def run(self):
+        import tkinter as tk
+        from tkinter import ttk
+
         self.max_value = 1
         self.value = 0
         self.execution_times = []
@@ -180,17 +411,357 @@ class ProgressWindow(threading.Thread):
             return str(hours) + 'h ' + str(minutes) + 'm remaining'
         return 'calculating...'
         
+    # Several scraping workers may finish an article at the same time, so updates are made one at a time
     def update_all(self, execution_time):
-        self.value += 1
-        self.execution_times.append(execution_time)
-        self.update_gui()
+        with self.lock:
+            self.value += 1
+            self.execution_times.append(execution_time)
+            self.update_gui()
         
     def quit(self):
         self.root.destroy()
 
+
+
+
+#########################
+##     DRIVER POOL     ##
+#########################
+
+# The DriverPool class keeps a fixed number of headless Chrome sessions, each created with get_new_driver(), that are
+# shared between the scraping workers in Gaqipu.py. A worker takes a driver from the pool, loads a page with it, and
+# then gives it back. If a driver crashes, only that driver is replaced - the rest of the pool carries on as normal.
+# When a profile directory is given, each driver in the pool has a profile of its own inside it (Chrome won't share one
+# between running sessions), which is handed on to the driver that replaces it.
+# Chrome uses more and more memory, and gets slower, the more pages it loads. So that long runs don't slow down until
+# they crash, a driver is recycled (quit and replaced) when it is given back after max_pages pages, or once its Chrome
+# processes use more than max_memory bytes between them. Memory is checked every check_interval pages, and only when
+# psutil is installed.
+# Starting Chrome takes a few seconds, so the pool also keeps spares fully started drivers waiting in the background.
+# A driver that is replaced is swapped for a spare straight away, and is then quit on the spare thread, which starts a
+# new spare (with the old driver's profile, now that it is free) in its place.
+# If no spare is ready and a new driver can't be started either, a MissingDriver is put in the pool in its place, so
+# that the pool never shrinks. The driver is started when the MissingDriver is next acquired instead.
+
+class DriverPool:
+
+    def __init__(self, size, lean=False, profile_dir=None, max_pages=None, max_memory=None, check_interval=10, spares=0):
+        self.size = size
+        self.lean = lean
+        self.profile_dir = profile_dir
+        self.max_pages = max_pages
+        self.max_memory = max_memory
+        self.check_interval = check_interval
+        self.spares = spares
+        self.available = queue.Queue()
+        self.drivers = []
+        self.profiles = {}
+        self.pages = {}
+        self.lock = threading.Lock()
+        # Started spare drivers, as (driver, profile), and drivers waiting to be quit and replaced by a new spare
+        self.spare_drivers = queue.Queue()
+        self.retired = queue.Queue()
+        self.spare_thread = None
+        self.stopping = False
+
+    def start(self):
+        for i in range(self.size):
+            profile = self.get_profile('driver_' + str(i))
+            self.add_driver(get_new_driver(self.lean, profile), profile)
+
+        if self.spares > 0:
+            self.spare_thread = threading.Thread(target=self.keep_spares, daemon=True)
+            self.spare_thread.start()
+            for i in range(self.spares):
+                self.retired.put((None, self.get_profile('spare_' + str(i))))
+
+    def get_profile(self, name):
+        if self.profile_dir == None:
+            return None
+        return os.path.join(self.profile_dir, name)
+
+    # Run on the spare thread. Quits each retired driver, and starts a spare with its profile, until quit_all() is called
+    def keep_spares(self):
+        while True:
+            retired = self.retired.get()
+            if retired == None:
+                return
+            driver, profile = retired
+            if driver != None:
+                quit_driver(driver)
+            if self.stopping:
+                continue
+            try:
+                self.spare_drivers.put((get_new_driver(self.lean, profile), profile))
+            except Exception as e:
+                print('Could not start a spare driver: ' + str(e) + '\n')
+
+    def add_driver(self, driver, profile=None):
+        self.register_driver(driver, profile)
+        self.available.put(driver)
+
+    def register_driver(self, driver, profile):
+        with self.lock:
+            self.drivers.append(driver)
+            self.profiles[driver] = profile
+            self.pages[driver] = 0
+
+    # Blocks until a driver is free. If it is a MissingDriver, a new driver is started for it first - should that fail
+    # again, the MissingDriver is put back for the next worker to try, and the error is passed on
+    def acquire(self):
+        driver = self.available.get()
+        if not isinstance(driver, MissingDriver):
+            return driver
+        try:
+            new_driver = get_new_driver(self.lean, driver.profile)
+        except:
+            self.available.put(driver)
+            raise
+        self.register_driver(new_driver, driver.profile)
+        return new_driver
+
+    # Gives back a driver that has loaded a page, recycling it first if it has loaded too many pages or uses too much memory
+    def release(self, driver):
+        with self.lock:
+            self.pages[driver] = self.pages.get(driver, 0) + 1
+            pages = self.pages[driver]
+
+        reason = None
+        if self.max_pages != None and pages >= self.max_pages:
+            reason = str(pages) + ' pages'
+        elif self.max_memory != None and psutil != None and pages % self.check_interval == 0:
+            memory = get_driver_memory(driver)
+            if memory > self.max_memory:
+                reason = str(round(memory / (1024 * 1024))) + ' MB'
+
+        if reason == None:
+            self.available.put(driver)
+        else:
+            print('Recycling a driver after ' + reason + '\n')
+            self.replace(driver)
+
+    # Quits a broken driver and puts a brand new session in its place - a spare if one is ready, so that the worker
+    # doesn't have to wait for Chrome to start
+    def replace(self, driver):
+        with self.lock:
+            if driver in self.drivers:
+                self.drivers.remove(driver)
+            profile = self.profiles.pop(driver, None)
+            self.pages.pop(driver, None)
+
+        try:
+            spare, spare_profile = self.spare_drivers.get_nowait()
+        except queue.Empty:
+            spare = None
+        if spare != None:
+            self.add_driver(spare, spare_profile)
+            self.retired.put((driver, profile))
+        else:
+            quit_driver(driver)
+            try:
+                self.add_driver(get_new_driver(self.lean, profile), profile)
+            except Exception as e:
+                print('Could not start a new driver: ' + str(e) + '. It will be started when it is next needed\n')
+                self.available.put(MissingDriver(profile))
+
+    # The drivers need to be closed, otherwise they stay open in the background
+    def quit_all(self):
+        # Drivers already waiting to be retired are quit, but no more spares are started
+        self.stopping = True
+        if self.spare_thread != None:
+            self.retired.put(None)
+            self.spare_thread.join()
+            self.spare_thread = None
+        while not self.retired.empty():
+            retired = self.retired.get()
+            if retired != None and retired[0] != None:
+                quit_driver(retired[0])
+        while not self.spare_drivers.empty():
+            quit_driver(self.spare_drivers.get()[0])
+
+        with self.lock:
+            for driver in self.drivers:
+                quit_driver(driver)
+            self.drivers = []
+            self.profiles = {}
+            self.pages = {}
+
+
+
+# Takes the place of a driver that couldn't be started in the DriverPool, keeping the profile the driver is to use
+class MissingDriver:
+
+    def __init__(self, profile):
+        self.profile = profile
+
+
+
+def quit_driver(driver):
+    try:
+        driver.quit()
+    except:
+        pass
+
+
+
+# Returns the memory used by a driver's chromedriver and Chrome processes, in bytes. Chrome runs every tab, renderer and
+# GPU process separately, so the whole tree of processes is added up
+def get_driver_memory(driver):
+    try:
+        process = psutil.Process(driver.service.process.pid)
+        memory = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                memory += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return memory
+    except (psutil.Error, AttributeError):
+        return 0
+
+
+
+        
+#########################
+##   SCRAPER OUTPUT    ##
+#########################
+
+# The ScraperOutput class collects the results of all of the scraping workers in Gaqipu.py, and records them in the
+# ResultStore (see store.py), which keeps them safe should the program crash. A url that failed for a reason worth
+# retrying is handed to the RetryScheduler instead of being finished.
+# Both record() and slip() return the time since the previous url was finished, which is passed on to the
+# ProgressWindow, or None if the url is to be retried. As many urls are searched at once, this gives a better estimate
+# of the time remaining than the time taken by each url. A url that isn't to be retried only counts as finished once
+# finish() is called, after everything else about it has been recorded, so that wait_for_all() can't return while it is
+# still being written.
+
+class ScraperOutput:
     
+    def __init__(self, store, retries):
+        self.store = store
+        self.retries = retries
+        self.finished = 0
+        self.expected = 0
+        self.expecting = True
+        self.last_finish_time = time.perf_counter()
+        self.condition = threading.Condition()
         
+    # failure is one of Failures, or None if the page was searched successfully
+    def record(self, item, data, write_to_file, das_found, author_found, failure=None):
+        if failure != None and self.retries.schedule(item, failure):
+            self.store.record(item.url, 'retry', item.get_elapsed_time(), data, das_found, author_found, write_to_file)
+            return None
+
+        # A url that was never searched is left for the next run, even once it has run out of attempts
+        if data == None:
+            status = 'retry'
+        else:
+            status = 'done'
+        self.store.record(item.url, status, item.get_elapsed_time(), data, das_found, author_found, write_to_file)
         
+        with self.condition:
+            now = time.perf_counter()
+            execution_time = now - self.last_finish_time
+            self.last_finish_time = now
+            return execution_time
+                
+    # Called when a url couldn't be searched at all, because its page couldn't be loaded
+    def slip(self, item):
+        return self.record(item, None, False, None, None, Failures.TIMEOUT)
+            
+    def finish(self):
+        with self.condition:
+            self.finished += 1
+            self.condition.notify_all()
+    
+    # Called for every url as it is handed to the workers. Urls are read lazily, so the number to wait for is only
+    # known once stop_expecting() has been called
+    def expect(self):
+        with self.condition:
+            self.expected += 1
+
+    def stop_expecting(self):
+        with self.condition:
+            self.expecting = False
+            self.condition.notify_all()
+
+    # Blocks until every expected url has been finished. Urls waiting to be retried are not finished yet
+    def wait_for_all(self):
+        with self.condition:
+            while self.expecting or self.finished < self.expected:
+                self.condition.wait()
+
+
+
+
+
+#########################
+##   RETRY SCHEDULER   ##
+#########################
+
+# The RetryScheduler gives each failed url another chance on its own, without waiting for the rest of the run to finish.
+# Failed urls wait in a heap ordered by the time they are due, and the scheduler's thread puts each one back on
+# retry_queue when its time comes, in between the urls being searched for the first time. The wait doubles with every
+# attempt, from base_delay up to max_delay seconds, and is jittered so that urls which failed together (e.g. while a
+# publisher's site was down) are not all tried again at the same moment.
+# Only the failures listed in retryable are retried, and no url is tried more than max_attempts times in total.
+
+class RetryScheduler(threading.Thread):
+
+    def __init__(self, retry_queue, max_attempts, retryable, base_delay=5, max_delay=300):
+        threading.Thread.__init__(self, daemon=True)
+        self.retry_queue = retry_queue
+        self.max_attempts = max_attempts
+        self.retryable = retryable
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.waiting = []
+        self.count = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+
+    # Returns True if the item will be retried, or False if the failure isn't worth retrying or the item has run out of
+    # attempts
+    def schedule(self, item, failure):
+        item.attempts += 1
+        if failure not in self.retryable or item.attempts >= self.max_attempts:
+            return False
+
+        delay = self.get_delay(item.attempts)
+        print('>>  ' + failure + ' on ' + item.url.link + '. Retrying in ' + str(round(delay)) + 's (attempt ' + str(item.attempts + 1) + ' of ' + str(self.max_attempts) + ')\n')
+        with self.condition:
+            # The count keeps items that are due at the same time in the order they failed
+            self.count += 1
+            heapq.heappush(self.waiting, (time.time() + delay, self.count, item))
+            self.condition.notify()
+        return True
+
+    def get_delay(self, attempts):
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def run(self):
+        with self.condition:
+            while not self.stopped:
+                if len(self.waiting) == 0:
+                    self.condition.wait()
+                elif self.waiting[0][0] > time.time():
+                    self.condition.wait(self.waiting[0][0] - time.time())
+                else:
+                    item = heapq.heappop(self.waiting)[2]
+                    item.clear_html()
+                    item.start_timer()
+                    self.retry_queue.put(item)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+
+
+
+
 #########################
 ##   PUBLISHER CLASS   ##
 #########################
@@ -227,6 +798,111 @@ class Publisher:
     
         
         
+#########################
+##   CONFIG REGISTRY   ##
+#########################
+        
+# The ConfigRegistry is built once all configurations and publishers have been read from config.csv. It resolves every
+# journal's configurations up front (including the $publisher-standard functionality), so that looking up the
+# configurations for any url is a single dictionary lookup, whatever order the urls arrive in.
+# It also maps article hostnames to publishers, so that urls whose journal has no configurations can still be searched
+# with their publisher's configurations. Hostnames are learnt from urls whose journal is known, on top of the defaults
+# below.
+# The registry counts how many statements each configuration has found for each journal, so that a journal's
+# configurations can be tried in order of how often they have matched, rather than in the order of config.csv. The
+# counts are kept in the ResultStore between runs.
+        
+class ConfigRegistry:
+    
+    DEFAULT_HOSTS = {
+        'tandfonline.com': 'taylor & francis',
+        'wiley.com': 'wiley',
+        'sciencedirect.com': 'elsevier',
+        'elsevier.com': 'elsevier',
+        'springeropen.com': 'springer',
+        'biomedcentral.com': 'springer',
+        'springer.com': 'springer'
+    }
+    
+    def __init__(self, configs, publishers):
+        self.publishers = {}
+        for p in publishers:
+            self.publishers[p.name] = p
+            
+        self.journals = {}
+        for c in configs:
+            if c.journal not in self.journals:
+                self.journals[c.journal] = []
+            # In journals with many links but few data availability statements, the $publisher-standard functionality
+            # was implemented. In these cases, the journal is given all configurations under its publisher, and
+            # searches through all of them. Examples of this can be seen in the config.csv file provided.
+            if c.identifier == '$publisher-standard':
+                self.journals[c.journal].extend(self.publishers[c.publisher].get_publisher_standard())
+            else:
+                self.journals[c.journal].append(c)
+                
+        self.hosts = {}
+        for host, publisher in self.DEFAULT_HOSTS.items():
+            if publisher in self.publishers:
+                self.hosts[host] = publisher
+                
+        self.hits = {}
+        self.lock = threading.Lock()
+
+    def get_publisher(self, name):
+        return self.publishers.get(name)
+                
+    def get_journal_configs(self, journal):
+        return self.journals.get(journal, [])
+    
+    # Returns the configurations of the publisher hosting the link, or an empty list if the host is unknown.
+    # www.sciencedirect.com is looked up as www.sciencedirect.com, then sciencedirect.com, and so on
+    def get_host_configs(self, link):
+        host = urlsplit(link).hostname or ''
+        while host != '':
+            if host in self.hosts:
+                return self.publishers[self.hosts[host]].get_publisher_standard()
+            host = host.partition('.')[2]
+        return []
+    
+    def learn_host(self, link, configs):
+        host = urlsplit(link).hostname
+        if host != None and host not in self.hosts and len(configs) > 0:
+            self.hosts[host] = configs[0].publisher
+
+    # Returns the configurations with the ones that have found the most statements for the journal first. Configurations
+    # with the same number of hits stay in the order they were given
+    def sort_configs(self, journal, configs):
+        with self.lock:
+            hits = self.hits.get(journal)
+            if hits == None:
+                return configs
+            return sorted(configs, key=lambda c: -hits.get(c.key, 0))
+
+    # Called each time a configuration finds a statement for a journal
+    def add_hit(self, journal, key, count=1):
+        with self.lock:
+            if journal not in self.hits:
+                self.hits[journal] = {}
+            self.hits[journal][key] = self.hits[journal].get(key, 0) + count
+
+    # Adds the hits saved by an earlier run, as (journal, key, hits)
+    def load_hits(self, rows):
+        for journal, key, count in rows:
+            self.add_hit(journal, key, count)
+
+    # Returns every hit count as (journal, key, hits)
+    def get_hits(self):
+        with self.lock:
+            rows = []
+            for journal, hits in self.hits.items():
+                for key, count in hits.items():
+                    rows.append((journal, key, count))
+            return rows
+        
+    
+        
+        
 #########################
 ## CONFIGURATION CLASS ##
 #########################
@@ -237,7 +913,7 @@ class Publisher:
     
 class Configuration:
     
-    def __init__(self, publisher, journal, title_class, tag, identifier, search_tag, author_class, author_secondary_class, get_author_by_child):
+    def __init__(self, publisher, journal, title_class, tag, identifier, search_tag, author_class, author_secondary_class, get_author_by_child, requires_js='no', render_wait='10', request_rate='2', request_burst='4'):
         self.publisher = publisher.lower()
         self.journal = journal.lower()
         self.title_class = title_class
@@ -256,6 +932,36 @@ class Configuration:
             self.get_author_by_child = False
         else:
             self.get_author_by_child = True
+        # Some publishers only build the data availability section with JavaScript, so their pages must be rendered
+        # by a headless Chrome driver rather than fetched with a plain HTTP request
+        if requires_js == 'yes':
+            self.requires_js = True
+        else:
+            self.requires_js = False
+        # The longest a driver waits for the data availability header and authors to appear on a rendered page
+        self.render_wait = float(render_wait)
+        # How many pages can be downloaded from the publisher's host each second, and how many at once after a quiet
+        # spell (see HostScheduler in fetchers.py)
+        self.request_rate = float(request_rate)
+        self.request_burst = float(request_burst)
+        # The key identifies the configuration between runs, for the hit counts kept by the ConfigRegistry
+        self.key = '|'.join([self.publisher, self.journal, str(self.tag), self.identifier, self.search_tag])
+        self.compile_selectors()
+            
+    # Builds the XPath selectors used by the lxml parser backend (see extractor.py), so that they are only built once
+    # rather than for every page. The header text is passed in as an XPath variable when the selector is run
+    def compile_selectors(self):
+        if self.tag == None:
+            self.das_selector = '//text()[. = $identifier]'
+        else:
+            self.das_selector = '//' + self.tag + '[count(node()) = 1 and string(.) = $identifier]'
+        self.das_xpath = self.das_selector.replace('$identifier', get_xpath_string(self.identifier))
+        self.author_selector = get_class_selector(self.author_class)
+        if self.author_secondary_class == None:
+            self.author_secondary_selector = None
+        else:
+            self.author_secondary_selector = get_class_selector(self.author_secondary_class)
+        self.title_selector = '(' + get_class_selector(self.title_class) + ')[1]'
         
     def __str__(self):
         return 'CONFIG: [ ' + self.journal + ', ' + self.title_class + ', ' + self.tag + ', ' + self.identifier + ', ' + self.search_tag + ', ' + self.author_class + ', ' + self.author_secondary_class + ' ]'
@@ -267,16 +973,203 @@ class Configuration:
 ##     URL CLASS      ##
 ########################
     
-# A simple class for storing the journal and link to each article from urls.csv
+# A simple class for storing the journal and link to each article from urls.csv. The journal is lowercased, but the link
+# is only canonicalised (see canonicalise_link), as the paths of many links (e.g. DOIs) are case sensitive
     
 class Url:
+
+    # A run can hold a very large number of urls, so they are given slots rather than a __dict__ each
+    __slots__ = ('journal', 'link')
     
     def __init__(self, journal, link):
         self.journal = journal.lower()
-        self.link = link.lower()
+        self.link = canonicalise_link(link)
         
     def __str__(self):
         return 'URL: [ ' + self.journal + ', ' + self.link + ' ]'
+
+    # Returns a key that is the same for every link to the same article, so that duplicates can be left out
+    def get_article_key(self):
+        return get_article_key(self.link)
+
+
+
+# Query parameters that only track where a link was clicked, and never change the page
+TRACKING_PARAMETERS = ['utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content', 'fbclid', 'gclid', 'mc_cid', 'mc_eid']
+
+# Publishers that serve the same article at several paths, such as an abstract page and a full text page. Every one of
+# them is treated as the full text page, which is where the data availability statement is
+ARTICLE_PATHS = [
+    (re.compile(r'^/doi/(?:abs|pdf|epdf|epub|reader)/'), '/doi/full/'),
+    (re.compile(r'^/science/article/abs/pii/'), '/science/article/pii/')
+]
+
+# Matches a DOI, which is case insensitive, or an Elsevier PII in a link's path
+DOI_PATTERN = re.compile(r'/(10\.\d{4,9}/[^?#]+?)/?$')
+PII_PATTERN = re.compile(r'/pii/([0-9A-Za-z]+)')
+
+DOI_HOSTS = ['doi.org', 'dx.doi.org', 'www.doi.org']
+
+
+
+# Canonicalises a link without changing the page it points to. The scheme and host are lowercased, default ports,
+# fragments and tracking parameters are removed, and an empty path becomes '/'. doi.org links are all given the same
+# form, and abstract pages are swapped for full text pages (see ARTICLE_PATHS). The case of the path is left as it is
+def canonicalise_link(link):
+    parts = urlsplit(link.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port != None and not ((scheme == 'http' and port == 80) or (scheme == 'https' and port == 443)):
+        host += ':' + str(port)
+
+    path = parts.path or '/'
+    if host in DOI_HOSTS:
+        scheme = 'https'
+        host = 'doi.org'
+    for pattern, replacement in ARTICLE_PATHS:
+        path = pattern.sub(replacement, path)
+
+    query = []
+    for parameter in parts.query.split('&'):
+        if parameter != '' and parameter.split('=')[0].lower() not in TRACKING_PARAMETERS:
+            query.append(parameter)
+    return urlunsplit((scheme, host, path, '&'.join(query), ''))
+
+
+
+# Returns a key that is the same for every link to the same article: its DOI (lowercased, as DOIs are case insensitive)
+# or Elsevier PII if the link has one, and the canonical link otherwise. This way a doi.org link and the publisher's
+# own link to an article are known to be duplicates without having to be fetched
+def get_article_key(link):
+    path = urlsplit(link).path
+    match = DOI_PATTERN.search(path)
+    if match != None:
+        return 'doi:' + match.group(1).lower()
+    match = PII_PATTERN.search(path)
+    if match != None:
+        return 'pii:' + match.group(1).upper()
+    return link
+
+
+
+# Returns a fingerprint of a journal's configurations, which changes whenever config.csv is changed in a way that could
+# change what is found on its pages
+def get_configs_fingerprint(configs):
+    keys = sorted([c.key + '|' + c.title_class + '|' + c.author_class + '|' + str(c.author_secondary_class) + '|' + str(c.get_author_by_child) for c in configs])
+    return hashlib.sha1('\n'.join(keys).encode('utf-8')).hexdigest()
+
+
+
+# Returns a hash of a page's HTML, to tell whether it has changed since an earlier run
+def get_content_hash(html):
+    return hashlib.sha256(html.encode('utf-8')).hexdigest()
+    
+    
+    
+    
+
+########################
+##     WORK ITEM      ##
+########################
+    
+# A WorkItem is a single url making its way through the stages of Gaqipu.py (see run_scraper), along with its journal's
+# configurations. Once the page has been fetched, its HTML is stored here too, along with whether it was rendered by a
+# headless Chrome driver.
+    
+class WorkItem:
+    
+    def __init__(self, url, configs):
+        self.url = url
+        self.configs = configs
+        self.html = None
+        self.rendered = False
+        self.attempts = 0
+        self.timings = {}
+        # Every stage and step timed, in the order they happened, for the SlowPageProfiler. Unlike timings, each attempt
+        # at a url that is retried is listed separately
+        self.steps = []
+        self.start_time = time.perf_counter()
+        # What was found on the page in an earlier run, if it can be used again should the page not have changed (a
+        # PageRecord, see store.py), and the validators and hash of the page downloaded in this run
+        self.previous = None
+        self.etag = None
+        self.last_modified = None
+        self.content_hash = None
+        self.not_modified = False
+        
+    def set_html(self, html, rendered=False):
+        self.html = html
+        self.rendered = rendered
+        
+    def clear_html(self):
+        self.html = None
+
+    # Records the validators the server sent with the page, so that later runs can ask whether it has changed
+    def set_validators(self, etag, last_modified):
+        self.etag = etag
+        self.last_modified = last_modified
+
+    # Called when the server says the page hasn't changed since the earlier run. The earlier run's validators and hash
+    # are kept, as no page was sent
+    def set_not_modified(self):
+        self.not_modified = True
+        self.content_hash = self.previous.content_hash
+        if self.etag == None:
+            self.etag = self.previous.etag
+        if self.last_modified == None:
+            self.last_modified = self.previous.last_modified
+
+    # Returns the headers that ask the server to only send the page if it has changed since the earlier run
+    def get_conditional_headers(self):
+        headers = {}
+        if self.previous != None:
+            if self.previous.etag != None:
+                headers['If-None-Match'] = self.previous.etag
+            if self.previous.last_modified != None:
+                headers['If-Modified-Since'] = self.previous.last_modified
+        return headers
+
+    # Returns True if the downloaded page is the same as the one searched in the earlier run, so it doesn't need searching
+    # again. A page that has since been rendered by a driver is always searched
+    def is_unchanged(self):
+        if self.previous == None or self.rendered:
+            return False
+        return self.not_modified or (self.content_hash != None and self.content_hash == self.previous.content_hash)
+        
+    # The timer is started again when the url is handed over to be fetched, so that the time recorded for it doesn't
+    # include the time spent waiting for the rest of the urls to be set up
+    def start_timer(self):
+        self.start_time = time.perf_counter()
+        
+    def get_elapsed_time(self):
+        return time.perf_counter() - self.start_time
+
+    # Adds to the time spent in a stage (see metrics.py). A url that is retried adds to the same stages again
+    def add_timing(self, stage, seconds):
+        self.timings[stage] = self.timings.get(stage, 0) + seconds
+        self.steps.append([stage, seconds])
+
+    # Records a step within a stage (e.g. loading the page while it is rendered) that started at start, and returns the
+    # time it finished. Steps are only kept for the SlowPageProfiler, and aren't counted in the stage timings
+    def add_step(self, step, start):
+        now = time.perf_counter()
+        self.steps.append([step, now - start])
+        return now
+
+    def get_publisher(self):
+        if len(self.configs) > 0:
+            return self.configs[0].publisher
+        return 'unknown'
+        
+    def requires_js(self):
+        for c in self.configs:
+            if c.requires_js:
+                return True
+        return False
     
     
     
@@ -301,6 +1194,33 @@ class SearchConstants:
     
     
     
+########################
+##      FAILURES      ##
+########################
+
+# Failures describe why a url couldn't be finished. A timeout (a driver crashing or timing out, or a page that couldn't
+# be loaded) may well not happen again, so it is worth retrying. A page that was searched and held no statement, or
+# several, will give the same result however many times it is searched.
+
+class Failures:
+
+    TIMEOUT = 'timeout'
+    NOT_FOUND = 'not-found'
+    AMBIGUOUS = 'ambiguous'
+
+    # Returns the failure for a searched page, or None if the search succeeded
+    @staticmethod
+    def classify(das_found, author_found):
+        if das_found == SearchConstants.AMBIGUOUS:
+            return Failures.AMBIGUOUS
+        if das_found != SearchConstants.FOUND and author_found != SearchConstants.FOUND:
+            return Failures.NOT_FOUND
+        return None
+
+
+
+
+
 ########################
 ##    ANALYSIS LOG    ##
 ########################
@@ -308,36 +1228,42 @@ class SearchConstants:
 # The AnalysisLog stores statistics relating to Gaqipu's scraping as a series of JournalReport instances.
 # It can format and return its data on request.
     
+# Reports are looked up by journal name rather than by a 'current' report, as urls from several journals can be
+# searched at the same time by the scraping workers. All changes to the reports are made under a lock.
+
 class AnalysisLog:
-        
+
     def __init__(self):
         self.journal_reports = []
-        self.index = -1
+        self.reports_by_name = {}
+        self.lock = threading.Lock()
         self.total = JournalReport('Total Data Collected')
         self.total_report_generated = False
-        
+
     def start_new_report(self, name):
-        self.journal_reports.append(JournalReport(name))
-        self.index += 1
-        
+        with self.lock:
+            report = JournalReport(name)
+            self.journal_reports.append(report)
+            self.reports_by_name[name] = report
+
     def find_report(self, name):
-        for i in range(len(self.journal_reports)):
-            if self.journal_reports[i].name == name:
-                self.index = i
+        with self.lock:
+            if name in self.reports_by_name:
                 return None
         # If a report by the given name isn't found, start a new report
-        self.index = len(self.journal_reports) - 1
         self.start_new_report(name)
         return True
-        
-    def add_url_to_report(self, das, author, iteration):
-        if self.index != -1:
-            return self.journal_reports[self.index].add_url(das, author, iteration)
-            
-    def add_configs_to_report(self, number):
-        if self.index != -1:
-            self.journal_reports[self.index].add_configs(number)
-            
+
+    def add_url_to_report(self, name, das, author):
+        with self.lock:
+            if name in self.reports_by_name:
+                self.reports_by_name[name].add_url(das, author)
+
+    def add_configs_to_report(self, name, number):
+        with self.lock:
+            if name in self.reports_by_name:
+                self.reports_by_name[name].add_configs(number)
+
     def generate_log(self):
         log = ''
         
@@ -381,15 +1307,11 @@ class JournalReport:
         self.urls_found_nothing = 0
         self.ambiguous_urls = 0
     
-    # Returns True if the url is to be retried in the next iteration, False otherwise
-    def add_url(self, das, authors, iteration):
+    # Only called once a url is finished, so a url that was retried is counted once
+    def add_url(self, das, authors):
         self.urls_searched += 1
         if das == False and authors == False:
-            if iteration == 4:
-                self.urls_found_nothing += 1
-                return False
-            else:
-                return True
+            self.urls_found_nothing += 1
         else:
             if das == 1:
                 self.urls_found_das += 1
@@ -397,7 +1319,6 @@ class JournalReport:
                 self.ambiguous_urls += 1
             if authors:
                 self.urls_found_authors += 1
-            return False
             
     def add_configs(self, number):
         self.configs_found += number
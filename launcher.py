@@ -1,19 +1,49 @@
 import subprocess
+import sys
+import os
+import hashlib
 
 
 # launcher.py installs the packages and libraries required to run the Gaqipu web scraper.
 # It also initialises a new virtual environment for the scraper to run in.
 # Once all requirements have been checked, Gaqipu is launched automatically.
+# Setting up the environment takes a while, so once it has succeeded a stamp of requirements.txt and the version of
+# Python is saved in STAMP_FILE. Later launches skip straight to Gaqipu unless either of them has changed.
 
+STAMP_FILE = 'venv/gaqipu_stamp.txt'
 
 
-# Calls a list of python-related cmd commands using the subprocess library
+
+# Calls a list of python-related cmd commands using the subprocess library. Returns True if every command succeeded
 def call_python_subprocesses(include_m, commands):
     prefix = 'python '
     if include_m == True:
         prefix += '-m '
+    succeeded = True
     for c in commands:
-        subprocess.run(prefix + c)
+        if subprocess.run(prefix + c).returncode != 0:
+            succeeded = False
+    return succeeded
+
+
+
+# Returns a hash of requirements.txt and the version of Python running the launcher
+def get_environment_stamp():
+    with open('requirements.txt', 'rb') as requirements_file:
+        requirements = requirements_file.read()
+    return hashlib.sha256(requirements + sys.version.encode('utf-8')).hexdigest()
+
+
+
+# Returns True if the environment was set up with the same requirements.txt and version of Python as now
+def is_environment_ready(stamp):
+    if not os.path.exists('venv/Scripts/activate_this.py'):
+        return False
+    try:
+        with open(STAMP_FILE) as stamp_file:
+            return stamp_file.read().strip() == stamp
+    except OSError:
+        return False
         
 
 
@@ -23,15 +53,24 @@ def call_python_subprocesses(include_m, commands):
         
 print('Checking Pre-Requisits for Gaqipu Scraper...\n\n\n')
     
-call_python_subprocesses(True, [
-    'pip install --upgrade pip',
-    'pip install virtualenv',
-    'virtualenv venv'
-])
+stamp = get_environment_stamp()
+if is_environment_ready(stamp):
+    exec(open('venv/Scripts/activate_this.py').read(), {'__file__': 'venv/Scripts/activate_this.py'})
+    print('Pre-requisites unchanged since the last launch.')
+
+else:
+    succeeded = call_python_subprocesses(True, [
+        'pip install --upgrade pip',
+        'pip install virtualenv',
+        'virtualenv venv'
+    ])
 
-exec(open('venv/Scripts/activate_this.py').read(), {'__file__': 'venv/Scripts/activate_this.py'})
+    exec(open('venv/Scripts/activate_this.py').read(), {'__file__': 'venv/Scripts/activate_this.py'})
 
-call_python_subprocesses(True, ['pip install -r requirements.txt'])
+    # The stamp is only saved if everything was installed, so that a failed install is tried again next time
+    if call_python_subprocesses(True, ['pip install -r requirements.txt']) and succeeded:
+        with open(STAMP_FILE, 'w') as stamp_file:
+            stamp_file.write(stamp)
 
 print('\n\nPre-requisites met. Launching Gaqipu scraper...\n\n')
 
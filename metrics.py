@@ -0,0 +1,199 @@
+import json
+import threading
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# metrics.py contains the StageMetrics, which collect how long each stage of searching an article takes, for every
+# publisher and journal. While Gaqipu runs they can be read in Prometheus' text format from a local port, and once it
+# has finished a JSON summary is written next to log.txt.
+#
+# The stages are:
+#   lookup   - finding the journal's configurations
+#   fetch    - downloading the page with a plain HTTP request
+#   render   - rendering the page in a headless Chrome driver
+#   parse    - parsing the page's HTML
+#   das      - searching for the data availability statement
+#   authors  - searching for the authors
+#   title    - searching for the title
+#   write    - recording the result in the ResultStore
+#   total    - the whole time taken by the url, from being handed to the workers to being finished
+
+STAGES = ['lookup', 'fetch', 'render', 'parse', 'das', 'authors', 'title', 'write', 'total']
+
+# The upper bound of each histogram bucket, in seconds
+BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+
+
+########################
+##     HISTOGRAM      ##
+########################
+
+# Counts how many times fell into each of the BUCKETS (the last count is for times above the last bucket)
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        for i in range(len(self.counts)):
+            self.counts[i] += other.counts[i]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    # Returns an estimate of the given percentile: the upper bound of the bucket it falls into
+    def get_percentile(self, percentile):
+        if self.count == 0:
+            return None
+        target = self.count * percentile / 100
+        total = 0
+        for i in range(len(BUCKETS)):
+            total += self.counts[i]
+            if total >= target:
+                return min(BUCKETS[i], self.max)
+        return self.max
+
+    def get_summary(self):
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'total_seconds': round(self.sum, 3),
+            'mean_seconds': round(self.sum / self.count, 4),
+            'p50_seconds': self.get_percentile(50),
+            'p95_seconds': self.get_percentile(95),
+            'max_seconds': round(self.max, 4)
+        }
+
+
+
+
+########################
+##   STAGE METRICS    ##
+########################
+
+# Each (stage, publisher, journal) has a histogram of its own. Workers on several threads record times at once, so every
+# change is made under a lock
+
+class StageMetrics:
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def observe(self, stage, publisher, journal, seconds):
+        key = (stage, publisher, journal)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    # Records every stage timed on a finished WorkItem
+    def observe_item(self, item):
+        publisher = item.get_publisher()
+        for stage, seconds in item.timings.items():
+            self.observe(stage, publisher, item.url.journal, seconds)
+
+    # Returns every histogram in Prometheus' text exposition format
+    def to_prometheus(self):
+        lines = [
+            '# HELP gaqipu_stage_seconds Time taken by each stage of searching an article',
+            '# TYPE gaqipu_stage_seconds histogram'
+        ]
+        with self.lock:
+            for (stage, publisher, journal), histogram in sorted(self.histograms.items()):
+                labels = 'stage="' + escape_label(stage) + '",publisher="' + escape_label(publisher) + '",journal="' + escape_label(journal) + '"'
+                total = 0
+                for i in range(len(BUCKETS)):
+                    total += histogram.counts[i]
+                    lines.append('gaqipu_stage_seconds_bucket{' + labels + ',le="' + str(BUCKETS[i]) + '"} ' + str(total))
+                lines.append('gaqipu_stage_seconds_bucket{' + labels + ',le="+Inf"} ' + str(histogram.count))
+                lines.append('gaqipu_stage_seconds_sum{' + labels + '} ' + repr(histogram.sum))
+                lines.append('gaqipu_stage_seconds_count{' + labels + '} ' + str(histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    # Returns a summary of each stage, overall and broken down by publisher and by journal
+    def get_summary(self):
+        stages = {}
+        with self.lock:
+            for (stage, publisher, journal), histogram in self.histograms.items():
+                if stage not in stages:
+                    stages[stage] = {'all': Histogram(), 'publishers': {}, 'journals': {}}
+                stages[stage]['all'].merge(histogram)
+                for group, name in [('publishers', publisher), ('journals', journal)]:
+                    if name not in stages[stage][group]:
+                        stages[stage][group][name] = Histogram()
+                    stages[stage][group][name].merge(histogram)
+
+        summary = {}
+        for stage in sorted(stages, key=lambda s: STAGES.index(s) if s in STAGES else len(STAGES)):
+            summary[stage] = {
+                'all': stages[stage]['all'].get_summary(),
+                'publishers': {name: h.get_summary() for name, h in sorted(stages[stage]['publishers'].items())},
+                'journals': {name: h.get_summary() for name, h in sorted(stages[stage]['journals'].items())}
+            }
+        return summary
+
+    def write_summary(self, path):
+        with open(path, 'w') as summary_file:
+            json.dump(self.get_summary(), summary_file, indent=4)
+
+    # Serves the metrics at http://127.0.0.1:port/metrics from a background thread. If the port can't be used, Gaqipu
+    # carries on without it
+    def start_server(self, port):
+        try:
+            self.server = ThreadingHTTPServer(('127.0.0.1', port), partial(MetricsHandler, self))
+        except OSError as e:
+            print('Could not serve metrics on port ' + str(port) + ': ' + str(e) + '\n')
+            return
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print('Serving metrics at http://127.0.0.1:' + str(port) + '/metrics\n')
+
+    def stop_server(self):
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def __init__(self, metrics, *args, **kwargs):
+        self.metrics = metrics
+        BaseHTTPRequestHandler.__init__(self, *args, **kwargs)
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.metrics.to_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,127 @@
+import hashlib
+import io
+import json
+import os
+import pstats
+import threading
+
+from extractor import profile_search_html
+
+# The stages timed while searching a page, which profiling the search again can explain
+SEARCH_STAGES = ['parse', 'das', 'authors', 'title']
+
+
+# profiler.py contains the SlowPageProfiler, which keeps evidence of the pages that take far longer to search than the
+# rest, without slowing down the whole run by profiling every page.
+
+
+
+########################
+## SLOW PAGE PROFILER ##
+########################
+
+# Once a url is finished, the time spent working on it (fetching, rendering, searching and writing it - not waiting in a
+# queue) is compared with the urls finished before it. If it is slower than the given percentile of them, the profiler
+# saves, in a folder of its own inside directory:
+#   timings.json  - the url, its journal and publisher, the time spent in each stage (see metrics.py), the stage that
+#                   took longest, and every step timed in the order it happened, with each attempt listed separately
+#                   (e.g. loading the page in a driver, then waiting for its content to appear)
+#   page.html     - the page's HTML, if it was searched outside of the browser
+#   search.prof   - a cProfile profile of searching the page again, which can be opened with pstats or snakeviz
+#   search.txt    - the 30 functions in the profile with the most cumulative time
+# Downloading and rendering a page depend on the network and the browser, so they can't be repeated to be profiled - the
+# steps in timings.json show where their time went. Searching a page gives the same result every time, so the search
+# is only profiled again when it was the slowest stage. The profile is made in the extraction pool, so the workers don't
+# wait for it. No urls are saved until min_samples urls have been finished, so that the first few pages don't all count
+# as slow.
+
+class SlowPageProfiler:
+
+    def __init__(self, directory, percentile, pool, backend, window=1000, min_samples=50):
+        self.directory = directory
+        self.percentile = percentile
+        self.pool = pool
+        self.backend = backend
+        self.window = window
+        self.min_samples = min_samples
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    # Called when a url is finished, with the HTML it was searched in (or None)
+    def check(self, item, html):
+        latency = get_work_time(item)
+        with self.lock:
+            threshold = self.get_threshold()
+            self.latencies.append(latency)
+            # Only the most recent urls are compared with, so the threshold follows changes in speed during the run
+            if len(self.latencies) > self.window:
+                self.latencies.pop(0)
+
+        if threshold != None and latency > threshold:
+            self.capture(item, html, latency, threshold)
+
+    # Must be called while holding the lock
+    def get_threshold(self):
+        if len(self.latencies) < self.min_samples:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))]
+
+    def capture(self, item, html, latency, threshold):
+        path = os.path.join(self.directory, hashlib.sha1(item.url.link.encode('utf-8')).hexdigest()[:16])
+        os.makedirs(path, exist_ok=True)
+        slowest_stage = get_slowest_stage(item)
+        print('>>  Slow page (' + str(round(latency, 2)) + 's, mostly ' + str(slowest_stage) + ') saved to ' + path + '\n')
+
+        with open(os.path.join(path, 'timings.json'), 'w') as timings_file:
+            json.dump({
+                'link': item.url.link,
+                'journal': item.url.journal,
+                'publisher': item.get_publisher(),
+                'seconds': latency,
+                'threshold_seconds': threshold,
+                'percentile': self.percentile,
+                'stages': item.timings,
+                'slowest_stage': slowest_stage,
+                'steps': item.steps
+            }, timings_file, indent=4)
+
+        if html != None:
+            with open(os.path.join(path, 'page.html'), 'w', encoding='utf-8') as page_file:
+                page_file.write(html)
+        if html != None and slowest_stage in SEARCH_STAGES:
+            future = self.pool.submit(profile_search_html, html, item.configs, self.backend)
+            future.add_done_callback(lambda f: self.write_profile(f, path))
+
+    def write_profile(self, future, path):
+        try:
+            profile = future.result()
+        except Exception as e:
+            print('Could not profile the page saved to ' + path + ': ' + str(e))
+            return
+
+        with open(os.path.join(path, 'search.prof'), 'wb') as profile_file:
+            profile_file.write(profile)
+        summary = io.StringIO()
+        pstats.Stats(os.path.join(path, 'search.prof'), stream=summary).sort_stats('cumulative').print_stats(30)
+        with open(os.path.join(path, 'search.txt'), 'w') as summary_file:
+            summary_file.write(summary.getvalue())
+
+
+
+# Returns the stage the item spent the most time in, or None if no stages were timed
+def get_slowest_stage(item):
+    stages = [stage for stage in item.timings if stage != 'total']
+    if len(stages) == 0:
+        return None
+    return max(stages, key=lambda stage: item.timings[stage])
+
+
+
+# Returns the time spent working on the item, leaving out the time it spent waiting to be worked on
+def get_work_time(item):
+    seconds = 0
+    for stage, stage_seconds in item.timings.items():
+        if stage != 'total':
+            seconds += stage_seconds
+    return seconds
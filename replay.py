@@ -0,0 +1,118 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from helpers import give_error, fetch_configs_from_file, fetch_urls_from_file, clamp
+from helpers import AnalysisLog, ConfigRegistry
+from helpers import SearchConstants as sc
+from archive import find_archives, read_index, replay_page
+from extractor import get_parser_backend
+from store import ResultStore
+from writers import get_output_format, get_output_writer
+
+
+# replay.py searches the pages kept in the archive folder (see archive.py) again, with the configurations currently in
+# config.csv, and writes a fresh output.csv and log.txt. No pages are downloaded and no browser is started, so a change
+# to config.csv can be tried on every archived article in minutes, and accuracy_checker can sample the output of
+# several versions of config.csv against exactly the same pages.
+#
+#     python replay.py                       - searches every archive in the archive folder
+#     python replay.py archive/<name>.warc.gz --output replay_output --log replay_log.txt
+#
+# Where a url was archived more than once (downloaded and then rendered, or in several runs), the last copy archived is
+# searched. Results are written in the order of urls.csv, followed by any archived urls no longer in it.
+
+
+
+
+########################
+##      PAGES         ##
+########################
+
+# Returns (link, journal, archive path, offset, length) for the last copy of every page in the archives, in the order
+# of urls.csv
+def find_pages(archive_paths):
+    pages = {}
+    for archive_path in archive_paths:
+        for link, journal, rendered, offset, length in read_index(archive_path):
+            pages.pop(link, None)
+            pages[link] = (link, journal, archive_path, offset, length)
+
+    # Without urls.csv, the pages are kept in the order they were archived
+    positions = {}
+    if os.path.exists('urls.csv'):
+        for position, url in enumerate(fetch_urls_from_file()):
+            positions.setdefault(url.link, position)
+    archived = {link: index for index, link in enumerate(pages)}
+    return sorted(pages.values(), key=lambda page: (positions.get(page[0], len(positions)), archived[page[0]]))
+
+
+
+# Returns the configurations for a journal, as find_configs() in Gaqipu.py does. Configurations are tried in the order
+# of config.csv, so that a replay doesn't depend on which of them found the most statements in an earlier run
+def find_configs(registry, link, journal):
+    journal_configs = registry.get_journal_configs(journal)
+    if len(journal_configs) == 0:
+        return registry.get_host_configs(link)
+    registry.learn_host(link, journal_configs)
+    return journal_configs
+
+
+
+
+#####################
+### PROGRAM START ###
+#####################
+
+# The extraction processes import this file when they start, so the program itself must only run in the main process
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Searches the pages in Gaqipu archives again, without a browser')
+    parser.add_argument('archives', nargs='*', default=['archive'], help='the archives, or folders of archives, to search')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='the number of processes searching pages')
+    parser.add_argument('--backend', default='lxml', help="'lxml' or 'html.parser'")
+    parser.add_argument('--output-format', default='csv', help="'csv', 'jsonl' or 'parquet'")
+    parser.add_argument('--output', default='output', help='the output file, without an extension')
+    parser.add_argument('--log', default='log.txt', help='the log file')
+    arguments = parser.parse_args()
+
+    archive_paths = []
+    for path in arguments.archives:
+        if not os.path.exists(path):
+            give_error('Could not find the archive ' + path)
+        archive_paths.extend(find_archives(path))
+    pages = find_pages(archive_paths)
+    if len(pages) == 0:
+        give_error('No archived pages were found in ' + ', '.join(arguments.archives))
+    print('Searching', len(pages), 'archived page(s) from', len(archive_paths), 'archive(s)\n')
+
+    configs, publishers = fetch_configs_from_file()
+    registry = ConfigRegistry(configs, publishers)
+    backend = get_parser_backend(arguments.backend)
+    log = AnalysisLog()
+    page_configs = []
+    for link, journal, archive_path, offset, length in pages:
+        journal_configs = find_configs(registry, link, journal)
+        if log.find_report(journal):
+            log.add_configs_to_report(journal, len(journal_configs))
+        page_configs.append(journal_configs)
+
+    start = time.time()
+    writer = get_output_writer(get_output_format(arguments.output_format), arguments.output, ResultStore.COLUMNS)
+    with ProcessPoolExecutor(max_workers=arguments.processes) as pool:
+        results = pool.map(replay_page,
+            [page[2] for page in pages], [page[3] for page in pages], [page[4] for page in pages],
+            page_configs, [backend] * len(pages), chunksize=16)
+
+        for (link, journal, archive_path, offset, length), result in zip(pages, results):
+            print('[' + sc.PRINT_CODES[result.das_found + 1] + '][' + sc.PRINT_CODES[result.author_found + 1] + ']', link)
+            log.add_url_to_report(journal, das=clamp(result.das_found,0,2), author=clamp(result.author_found,0,1))
+            if clamp(result.das_found,0,1):
+                writer.write([journal, result.title, result.authors, link, result.statement, result.exception])
+    writer.close()
+
+    with open(arguments.log, 'w') as log_file:
+        log_file.write(log.generate_log())
+    print('\nSearched', len(pages), 'page(s) in', round(time.time() - start, 1), 'seconds')
+    print(log.get_total_report() + 'Full report available in ' + arguments.log)
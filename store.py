@@ -0,0 +1,313 @@
+import sqlite3
+import threading
+import time
+
+from helpers import Url
+from extractor import PageResult
+
+
+# store.py contains the ResultStore, which keeps track of every url's progress in a local SQLite database. If Gaqipu
+# stops part way through a run, the next run picks up exactly the urls that were not finished.
+
+
+
+
+########################
+##    RESULT STORE    ##
+########################
+
+# The ResultStore records each url's status, the number of times it has been searched, the data extracted from its page
+# and how long it took. Results are not written one at a time - they are held back and written together in a single
+# transaction once batch_size results are waiting, or flush_interval seconds have passed since the last write.
+# A url is one of:
+#   'pending'  - not searched yet
+#   'retry'    - searched, but to be searched again (nothing was found, or it crashed a driver)
+#   'done'     - finished. The output file is exported from these urls, with one row per link
+# When urls are shared out between several machines by a coordinator (see coordinator.py), the coordinator's store also
+# records which worker each url is leased to, and until when.
+# Each url is also given an article key (see get_article_key in helpers.py), so that an article reached through several
+# different links is only searched once. What was found on each downloaded page is kept in a table of its own, along
+# with the page's ETag, Last-Modified date and hash, so that a later run can skip pages that haven't changed.
+# Urls are read back a journal at a time in turn (the first url of every journal, then the second of every journal, and
+# so on), rather than in the order of urls.csv, so that requests are spread between the publishers' hosts.
+
+class ResultStore:
+
+    COLUMNS = ['JOURNAL','ARTICLE','AUTHOR(S)','LINK','DATA AVAILABILITY STATEMENT','NOTES']
+
+    # Results are recorded as (status, das_found, author_found, title, authors, statement, notes, write_to_file, seconds,
+    # updated, link)
+    RECORD_SQL = '''
+        UPDATE urls SET status = ?, attempts = attempts + 1, das_found = ?, author_found = ?, title = ?,
+        authors = ?, statement = ?, notes = ?, write_to_file = ?, seconds = ?, updated = ?
+        WHERE link = ?'''
+
+    # Urls are added as (link, journal, position, turn, article, article)
+    ADD_SQL = '''
+        INSERT OR IGNORE INTO urls (link, journal, position, turn, article) SELECT ?, ?, ?, ?, ?
+        WHERE NOT EXISTS (SELECT 1 FROM urls WHERE article = ?)'''
+
+    # Pages are recorded as (link, etag, last_modified, content_hash, configs, das_found, author_found, das_config,
+    # title, authors, statement, exception, updated)
+    PAGE_SQL = 'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+
+    def __init__(self, path, batch_size=50, flush_interval=5):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending_results = []
+        self.pending_pages = []
+        self.last_flush_time = time.time()
+        self.lock = threading.Lock()
+
+        # The connection is shared by all of the workers, so every use of it is made under the lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS urls (
+                link TEXT PRIMARY KEY,
+                journal TEXT,
+                position INTEGER,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                das_found INTEGER,
+                author_found INTEGER,
+                title TEXT,
+                authors TEXT,
+                statement TEXT,
+                notes TEXT,
+                write_to_file INTEGER DEFAULT 0,
+                seconds REAL,
+                updated REAL,
+                lease_owner TEXT,
+                lease_expires REAL,
+                article TEXT,
+                turn INTEGER DEFAULT 0
+            )''')
+        # Stores made before urls could be leased, deduplicated or interleaved don't have the newer columns
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(urls)').fetchall()]
+        for column, column_type in [('lease_owner', 'TEXT'), ('lease_expires', 'REAL'), ('article', 'TEXT'), ('turn', 'INTEGER DEFAULT 0')]:
+            if column not in columns:
+                self.connection.execute('ALTER TABLE urls ADD COLUMN ' + column + ' ' + column_type)
+        self.connection.execute('CREATE INDEX IF NOT EXISTS urls_article ON urls (article)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS urls_turn ON urls (turn, position)')
+        # The validators, hash and result of every downloaded page, kept when the urls are cleared. configs is the
+        # fingerprint of the configurations the page was searched with (see get_configs_fingerprint in helpers.py)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS pages (
+                link TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                content_hash TEXT,
+                configs TEXT,
+                das_found INTEGER,
+                author_found INTEGER,
+                das_config TEXT,
+                title TEXT,
+                authors TEXT,
+                statement TEXT,
+                exception TEXT,
+                updated REAL
+            )''')
+        # How many statements each configuration has found for each journal (see ConfigRegistry in helpers.py). This is
+        # kept when the urls are cleared
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS config_hits (
+                journal TEXT,
+                config TEXT,
+                hits INTEGER,
+                PRIMARY KEY (journal, config)
+            )''')
+        self.connection.commit()
+
+    # Adds urls to the store. Urls that are already in it, or whose article is already in it through another link
+    # (including duplicates in urls.csv), are left as they are. urls can be any iterable, and is read in chunks, so that
+    # a very large urls.csv never has to be held in memory. Each url's turn is the number of urls from its journal added
+    # before it
+    def add_urls(self, urls, chunk_size=10000):
+        with self.lock:
+            position = self.connection.execute('SELECT COUNT(*) FROM urls').fetchone()[0]
+            turns = dict(self.connection.execute('SELECT journal, COUNT(*) FROM urls GROUP BY journal').fetchall())
+            rows = []
+            for url in urls:
+                article = url.get_article_key()
+                turn = turns.get(url.journal, 0)
+                turns[url.journal] = turn + 1
+                rows.append((url.link, url.journal, position, turn, article, article))
+                position += 1
+                if len(rows) >= chunk_size:
+                    self.connection.executemany(self.ADD_SQL, rows)
+                    rows = []
+            self.connection.executemany(self.ADD_SQL, rows)
+            self.connection.commit()
+
+    def count_unfinished_urls(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM urls WHERE status != 'done'").fetchone()[0]
+
+    # Yields every url that hasn't been finished, taking a url from each journal in turn. Urls are read from the database
+    # a page at a time, so the store can be written to between pages
+    def iter_unfinished_urls(self, page_size=1000):
+        turn = -1
+        position = -1
+        while True:
+            with self.lock:
+                rows = self.connection.execute('''
+                    SELECT journal, link, turn, position FROM urls WHERE status != 'done' AND (turn > ? OR (turn = ? AND position > ?))
+                    ORDER BY turn, position LIMIT ?''', (turn, turn, position, page_size)).fetchall()
+            if len(rows) == 0:
+                return
+            for journal, link, turn, position in rows:
+                yield Url(journal, link)
+
+    # Returns (journal, das_found, author_found) for every finished url
+    def get_finished_results(self):
+        with self.lock:
+            self.write_pending_results()
+            return self.connection.execute("SELECT journal, das_found, author_found FROM urls WHERE status = 'done' ORDER BY position").fetchall()
+
+    # Returns every configuration's hits as (journal, config, hits)
+    def get_config_hits(self):
+        with self.lock:
+            return self.connection.execute('SELECT journal, config, hits FROM config_hits').fetchall()
+
+    # Replaces the saved hits with the given (journal, config, hits) rows
+    def save_config_hits(self, rows):
+        with self.lock:
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO config_hits (journal, config, hits) VALUES (?, ?, ?)', rows)
+
+    # Forgets every url, so that the next run starts from scratch
+    def clear(self):
+        with self.lock:
+            self.pending_results = []
+            self.connection.execute('DELETE FROM urls')
+            self.connection.commit()
+
+    # Records the result of searching a url. data is in the format [Journal, Title, Author(s), Link, Data Availability
+    # Statement, Notes], or None if the url crashed a driver
+    def record(self, url, status, seconds, data=None, das_found=None, author_found=None, write_to_file=False):
+        if data == None:
+            data = [url.journal, None, None, url.link, None, None]
+        result = (status, das_found, author_found, data[1], data[2], data[4], data[5], int(bool(write_to_file)), seconds, time.time(), url.link)
+
+        with self.lock:
+            self.pending_results.append(result)
+            if len(self.pending_results) >= self.batch_size or time.time() - self.last_flush_time >= self.flush_interval:
+                self.write_pending_results()
+
+    # Records what was found on a downloaded page, with the page's validators and hash, so that the result can be used
+    # again by a later run if the page hasn't changed. Pages are written along with the results
+    def record_page(self, link, etag, last_modified, content_hash, configs, result):
+        page = (link, etag, last_modified, content_hash, configs, result.das_found, result.author_found, result.das_config,
+                result.title, result.authors, result.statement, result.exception, time.time())
+        with self.lock:
+            self.pending_pages.append(page)
+
+    # Returns the PageRecord of a page downloaded in an earlier run, or None if there isn't one
+    def get_page(self, link):
+        with self.lock:
+            row = self.connection.execute('''
+                SELECT etag, last_modified, content_hash, configs, das_found, author_found, das_config, title, authors,
+                statement, exception FROM pages WHERE link = ?''', (link,)).fetchone()
+        if row == None:
+            return None
+        return PageRecord(*row)
+
+    def flush(self):
+        with self.lock:
+            self.write_pending_results()
+
+    # Must be called while holding the lock
+    def write_pending_results(self):
+        if len(self.pending_results) > 0 or len(self.pending_pages) > 0:
+            with self.connection:
+                self.connection.executemany(self.RECORD_SQL, self.pending_results)
+                self.connection.executemany(self.PAGE_SQL, self.pending_pages)
+            self.pending_results = []
+            self.pending_pages = []
+        self.last_flush_time = time.time()
+
+    # Returns the result of every url that has been searched, in the format given by RECORD_SQL, so that they can be
+    # merged into another store
+    def get_results(self):
+        with self.lock:
+            self.write_pending_results()
+            return self.connection.execute('''
+                SELECT status, das_found, author_found, title, authors, statement, notes, write_to_file, seconds, updated,
+                link FROM urls WHERE status != 'pending' ORDER BY position''').fetchall()
+
+    # Records results returned by get_results() on another store, and ends the leases of their urls
+    def merge_results(self, results):
+        with self.lock:
+            self.write_pending_results()
+            with self.connection:
+                self.connection.executemany(self.RECORD_SQL, results)
+                self.connection.executemany('UPDATE urls SET lease_owner = NULL, lease_expires = NULL WHERE link = ?', [(result[-1],) for result in results])
+
+    # Leases up to count urls to the owner for lease_seconds, and returns them. Urls that are finished, leased to
+    # someone else, or have been searched max_attempts times already are left out. A lease that runs out without the
+    # url's result being merged lets the url be leased again
+    def lease_urls(self, owner, count, lease_seconds, max_attempts):
+        now = time.time()
+        with self.lock:
+            rows = self.connection.execute('''
+                SELECT journal, link FROM urls WHERE status != 'done' AND attempts < ?
+                AND (lease_expires IS NULL OR lease_expires < ?) ORDER BY turn, position LIMIT ?''', (max_attempts, now, count)).fetchall()
+            with self.connection:
+                self.connection.executemany('UPDATE urls SET lease_owner = ?, lease_expires = ? WHERE link = ?', [(owner, now + lease_seconds, link) for journal, link in rows])
+        return [Url(journal, link) for journal, link in rows]
+
+    # Extends every lease held by the owner
+    def renew_leases(self, owner, lease_seconds):
+        with self.lock:
+            with self.connection:
+                self.connection.execute('UPDATE urls SET lease_expires = ? WHERE lease_owner = ? AND lease_expires IS NOT NULL', (time.time() + lease_seconds, owner))
+
+    # Returns the number of urls that are leased and whose leases haven't run out
+    def count_leased_urls(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM urls WHERE lease_expires >= ?', (time.time(),)).fetchone()[0]
+
+    # Returns the number of urls that could still be leased, now or once their leases run out
+    def count_leasable_urls(self, max_attempts):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM urls WHERE status != 'done' AND attempts < ?", (max_attempts,)).fetchone()[0]
+
+    # Writes every finished url with a data availability statement to an output writer (see writers.py), once per link,
+    # in the order the urls were added. Rows are read from the database in chunks, and the writer is closed at the end
+    def export(self, writer, chunk_size=1000):
+        with self.lock:
+            self.write_pending_results()
+            cursor = self.connection.execute('''
+                SELECT journal, title, authors, link, statement, notes FROM urls
+                WHERE status = 'done' AND write_to_file = 1 ORDER BY position''')
+            rows = cursor.fetchmany(chunk_size)
+            while len(rows) > 0:
+                writer.write_rows(rows)
+                rows = cursor.fetchmany(chunk_size)
+        writer.close()
+
+    def close(self):
+        with self.lock:
+            self.write_pending_results()
+            self.connection.close()
+
+
+
+# What was found on a page in an earlier run, with the validators and hash of the page it was found in. The result is
+# kept as a PageResult (see extractor.py), so it can be recorded in the same way as a page that has just been searched
+class PageRecord:
+
+    def __init__(self, etag, last_modified, content_hash, configs, das_found, author_found, das_config, title, authors, statement, exception):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_hash = content_hash
+        self.configs = configs
+        self.result = PageResult()
+        self.result.das_found = das_found
+        self.result.author_found = author_found
+        self.result.das_config = das_config
+        self.result.title = title
+        self.result.authors = authors
+        self.result.statement = statement
+        self.result.exception = exception
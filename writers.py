@@ -0,0 +1,158 @@
+import csv
+import json
+import os
+import time
+
+# pyarrow is only needed for the 'parquet' output format, and is slow to import, so it is only imported once that
+# format is chosen (see load_pyarrow)
+pyarrow = None
+
+
+# writers.py contains the output writers used to export Gaqipu's results. Rows are held back and written in batches,
+# once batch_size rows are waiting or flush_interval seconds have passed, and each batch is flushed all the way to disk.
+# The file is written under a temporary name and only replaces the previous output once it is complete, so a crash
+# part way through an export never leaves a half-written output file behind.
+#
+# Three formats are available:
+#   'csv'      - the original format, one row per article
+#   'jsonl'    - one JSON object per line, keyed by column name
+#   'parquet'  - a columnar file that can be loaded straight into pandas or Arrow (requires pyarrow)
+
+OUTPUT_FORMATS = {'csv': '.csv', 'jsonl': '.jsonl', 'parquet': '.parquet'}
+
+
+
+# Returns the given output format if it can be used, otherwise 'csv'
+def get_output_format(output_format):
+    if output_format == 'parquet' and not load_pyarrow():
+        print('pyarrow is not installed. Writing csv instead\n')
+        return 'csv'
+    if output_format not in OUTPUT_FORMATS:
+        print('Unknown output format ' + str(output_format) + '. Writing csv instead\n')
+        return 'csv'
+    return output_format
+
+
+
+# Returns a writer for the given format. The path is given without an extension
+def get_output_writer(output_format, path, columns):
+    path += OUTPUT_FORMATS[output_format]
+    if output_format == 'jsonl':
+        return JsonlWriter(path, columns)
+    if output_format == 'parquet':
+        return ParquetWriter(path, columns)
+    return CsvWriter(path, columns)
+
+
+
+# Imports pyarrow the first time it is needed. Returns False if it isn't installed
+def load_pyarrow():
+    global pyarrow
+    if pyarrow == None:
+        try:
+            import pyarrow as module
+            import pyarrow.parquet
+        except ImportError:
+            return False
+        pyarrow = module
+    return True
+
+
+
+
+########################
+##   OUTPUT WRITER    ##
+########################
+
+# The OutputWriter holds the batching and flushing shared by every format. Each format opens its file in open_file()
+# and writes a batch of rows in write_batch()
+
+class OutputWriter:
+
+    def __init__(self, path, columns, batch_size=1000, flush_interval=5):
+        self.path = path
+        self.temp_path = path + '.tmp'
+        self.columns = columns
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows = []
+        self.last_flush_time = time.time()
+        self.file = self.open_file()
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size or time.time() - self.last_flush_time >= self.flush_interval:
+            self.flush()
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write(row)
+
+    # Writes the waiting rows, and makes sure they have reached the disk
+    def flush(self):
+        if len(self.rows) > 0:
+            self.write_batch(self.rows)
+            self.rows = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_flush_time = time.time()
+
+    # Writes the last rows and replaces the previous output with the new file
+    def close(self):
+        self.flush()
+        self.close_file()
+        os.replace(self.temp_path, self.path)
+
+    def close_file(self):
+        self.file.close()
+
+
+
+class CsvWriter(OutputWriter):
+
+    def open_file(self):
+        output_file = open(self.temp_path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(output_file)
+        self.writer.writerow(self.columns)
+        return output_file
+
+    def write_batch(self, rows):
+        self.writer.writerows(rows)
+
+
+
+class JsonlWriter(OutputWriter):
+
+    def open_file(self):
+        return open(self.temp_path, 'w', encoding='utf-8')
+
+    def write_batch(self, rows):
+        lines = []
+        for row in rows:
+            lines.append(json.dumps(dict(zip(self.columns, row)), ensure_ascii=False) + '\n')
+        self.file.write(''.join(lines))
+
+
+
+# Each batch is written as a row group of its own. Every column is stored as a string
+class ParquetWriter(OutputWriter):
+
+    def open_file(self):
+        load_pyarrow()
+        output_file = open(self.temp_path, 'wb')
+        self.schema = pyarrow.schema([(column, pyarrow.string()) for column in self.columns])
+        self.writer = pyarrow.parquet.ParquetWriter(output_file, self.schema)
+        return output_file
+
+    def write_batch(self, rows):
+        columns = {}
+        for i in range(len(self.columns)):
+            columns[self.columns[i]] = [row[i] for row in rows]
+        self.writer.write_table(pyarrow.Table.from_pydict(columns, schema=self.schema))
+
+    def close_file(self):
+        # The Parquet footer has to be written before the file is synced for the last time
+        self.writer.close()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()